@@ -0,0 +1,93 @@
+# ==================================================
+# Welcome to the DotPub!
+#
+# Maintainer:
+#   KevInZhao <hellozhaowenkai@gmail.com>
+# Description:
+#   Answer the shell completion of publican from a precomputed index.
+# Note:
+#   It runs on every TAB press, so it must only import `os` and `sys`.
+# Sections:
+#   - Constants
+#   - Completion
+# Repository:
+#   - [DotPub](https://github.com/hellozhaowenkai/dotpub/)
+# ==================================================
+
+
+import os
+import sys
+
+
+# ==================================================
+# Constants
+# ==================================================
+
+
+ROOT_PATH = os.path.dirname(os.path.realpath(__file__))
+SCRIPT_FILENAME = "dotpub.py"  # The index goes stale with its parsers.
+COMPLETION_INDEX_FILENAME = "completion-index.tsv"
+
+
+# ==================================================
+# Completion
+# ==================================================
+
+
+def get_positionals(words, valued_options):
+    """Drop the options, and the values of those in `valued_options`."""
+
+    positionals = []
+    skip_value = False
+    for word in words:
+        if skip_value:
+            skip_value = False
+        elif word.startswith("-"):
+            skip_value = word in valued_options
+        else:
+            positionals.append(word)
+    return positionals
+
+
+def complete(words):
+    """Print the candidates for the last word, return False if the index is stale.
+
+    The index is written by `dotpub.py` whenever `counter/` changes, see
+    `dump_completion_index`.
+    """
+
+    try:
+        with open(
+            os.path.join(ROOT_PATH, "databases", COMPLETION_INDEX_FILENAME),
+            encoding="utf-8",
+        ) as index_file:
+            lines = [line.rstrip("\n").partition("\t") for line in index_file]
+        index = {key: values.split("\t") if values else [] for key, _, values in lines}
+        fresh = index["counter_mtime_ns"] == [
+            str(os.stat(os.path.join(ROOT_PATH, "counter")).st_mtime_ns)
+        ] and index["script_mtime_ns"] == [
+            str(os.stat(os.path.join(ROOT_PATH, SCRIPT_FILENAME)).st_mtime_ns)
+        ]
+    except (OSError, ValueError, KeyError):
+        fresh = False
+    if not fresh:
+        return False
+
+    current = words[-1] if words else ""
+    if current.startswith("-"):
+        return True
+
+    positionals = get_positionals(words[:-1], index["valued"])
+    if not positionals:
+        candidates = index["actions"]
+    elif positionals[0] not in index["actions"]:
+        candidates = []
+    elif positionals[0] == "brew" and len(positionals) == 1:
+        candidates = index["commands"]
+    else:
+        candidates = [name for name in index["formulae"] if name not in positionals]
+
+    sys.stdout.write(
+        "".join(f"{name}\n" for name in candidates if name.startswith(current))
+    )
+    return True
@@ -0,0 +1,4407 @@
+# ==================================================
+# Welcome to the DotPub!
+#
+# Maintainer:
+#   KevInZhao <hellozhaowenkai@gmail.com>
+# Description:
+#   Serve fruity dotfiles for brew fans!
+# Note:
+#   You need Python 3.9 or greater to run the following script.
+#   It is imported by `publican.py`, so it is compiled once and cached.
+# Sections:
+#   - Constants
+#   - Utilities
+#   - Databases
+#   - Journals
+#   - Backups
+#   - Stats
+#   - Brew Command
+#   - Menu Command
+#   - Order Command
+#   - Cancel Command
+#   - Tab Command
+#   - Recover Command
+#   - Serve Command
+#   - Fleet Command
+#   - Main
+# Repository:
+#   - [DotPub](https://github.com/hellozhaowenkai/dotpub/)
+# References:
+#   - [Mackup](https://github.com/lra/mackup/)
+#   - [Dotbot](https://github.com/anishathalye/dotbot/)
+# ==================================================
+
+
+import time
+import os
+import sys
+import re
+import json
+import fnmatch
+import functools
+import pathlib
+import stat
+import logging
+import threading
+import contextlib
+import itertools
+import queue
+import argparse
+import graphlib
+import shutil
+
+from completion import COMPLETION_INDEX_FILENAME, complete, get_positionals
+
+# The heavy or rarely used modules (e.g. `asyncio`, `tarfile`) are imported where
+# they are needed.
+
+
+# ==================================================
+# Constants
+# ==================================================
+
+
+VERSION = "1.4.2"
+ACTIONS = {
+    "brew": "Manage the supported formulae via brew.",
+    "menu": "List the supported formulae.",
+    "order": "Mount your formulae config files.",
+    "cancel": "Unmount your formulae config files.",
+    "tab": "Show the supported formulae status.",
+    "recover": "Recover the formulae from their unfinished journals.",
+    "serve": "Keep your formulae mounted while their files change.",
+    "fleet": "Mount your formulae on many hosts over SSH.",
+}
+STARTED_AT = None  # Taken by `publican.py` before this module is imported.
+STARTUP_MARKS = []
+
+ROOT_PATH = pathlib.Path(__file__).resolve().parent
+
+COUNTER_DIRNAME = "counter"
+COUNTER_PATH = ROOT_PATH / COUNTER_DIRNAME
+
+BACKUPS_DIRNAME = "backups"
+BACKUPS_PATH = ROOT_PATH / BACKUPS_DIRNAME
+BACKUP_STORE_PATH = BACKUPS_PATH / ".store"  # Formula names never start with a dot.
+BACKUP_OBJECTS_PATH = BACKUP_STORE_PATH / "objects"
+BACKUP_MANIFESTS_PATH = BACKUP_STORE_PATH / "manifests"
+BACKUP_MANIFEST_SUFFIX = ".json"
+BACKUP_SETTINGS_PATH = BACKUP_STORE_PATH / "settings.json"
+BACKUP_GENERATIONS = 10  # Until `order --keep-generations` saves another number.
+BACKUPS_LOCK = threading.RLock()
+RESTORE_GENERATION = None
+
+FORMULA_FLAG = "\uF7A5"  # Nerd Fonts: nf-mdi-glass_mug
+FORMULA_INFO_FILENAME = "formula-info.json"
+SUPPORTED_FORMULAE = None
+PATH_VARIABLE_PATTERN = re.compile(r"\$(?:\{(\w+)(?::-([^}]*))?\}|(\w+))")
+TEMPLATE_VARIABLE_PATTERN = re.compile(r"\$(?:\{(\w+)(?::-([^}]*))?\}|(\$))")
+PATH_MAX_SYMLINKS = 40
+DOTFILE_MODES = ("link", "copy", "template")
+HASH_CHUNK_SIZE = 1024 * 1024
+
+DATABASES_DIRNAME = "databases"
+DATABASES_PATH = ROOT_PATH / DATABASES_DIRNAME
+DATABASE_FILENAME = "dotpub.sqlite3"
+DATABASE_VERSION = 4
+DATABASE_SCHEMA = """
+CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE formulae (name TEXT PRIMARY KEY);
+CREATE TABLE formula_info (path TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER, info TEXT);
+CREATE TABLE mount_state (
+    system TEXT PRIMARY KEY,
+    counter TEXT,
+    backup TEXT,
+    target TEXT,
+    system_status TEXT,
+    system_fingerprint TEXT,
+    backup_status TEXT,
+    backup_fingerprint TEXT
+);
+CREATE TABLE formula_state (formula TEXT PRIMARY KEY, fingerprint TEXT, systems TEXT);
+CREATE TABLE brew_results (
+    key TEXT PRIMARY KEY,
+    bottle TEXT,
+    created REAL,
+    accessed REAL,
+    output TEXT
+);
+CREATE INDEX brew_results_bottle ON brew_results (bottle);
+"""
+MOUNT_STATE_COLUMNS = (
+    "system",
+    "counter",
+    "backup",
+    "target",
+    "system_status",
+    "system_fingerprint",
+    "backup_status",
+    "backup_fingerprint",
+)
+DATABASE = None
+DATABASE_LOCK = threading.RLock()
+
+JOURNALS_DIRNAME = "journals"
+JOURNALS_PATH = DATABASES_PATH / JOURNALS_DIRNAME
+JOURNAL_SUFFIX = ".journal"
+MOVE_OPS = {"backup-move", "restore-move"}
+SYMLINK_OPS = {"backup-symlink", "symlink", "restore-symlink"}
+UNLINK_OPS = {"backup-unlink", "unlink"}
+MKDIR_OPS = {"mkdir"}
+WRITE_OPS = {"write", "rewrite"}
+REMOVE_OPS = {"remove"}
+NOOP_OPS = {"skip-already-mounted", "skip-not-mounted", "conflict"}
+PLAN_JUST_WIDTH = 23
+PLANS = {}
+
+LOGS_DIRNAME = "logs"
+LOGS_PATH = ROOT_PATH / LOGS_DIRNAME
+LOGS_FILENAME = "receipt.log"
+METRICS_FILENAME = "metrics.jsonl"
+LOGGER = logging.getLogger()
+SIMPLIFY = False
+VERIFY = False
+DIFF = False
+DIFF_JOBS = 8
+DIFF_STATUSES = ("identical", "differs", "missing", "error")
+DIFF_SUMMARY = None
+DIFF_STARTED = None
+INCREMENTAL = False
+ROLLBACK = False
+DRY_RUN = False
+PLAN_JSON = None
+NORMAL = -1
+LEFT_JUST_WIDTH = 15
+LOG_FORMAT = "text"
+LOG_FORMATS = ("text", "json")
+LOG_COLORS = {
+    NORMAL: 4,  # Blue
+    logging.INFO: 2,  # Green
+    logging.WARNING: 3,  # Yellow
+    logging.ERROR: 1,  # Red
+}
+LOG_RECORD_SEPARATOR = "\x1e"  # Marks the lines which are JSON records already.
+OUTPUT_FORMAT = "table"
+OUTPUT_FORMATS = ("table", "json", "ndjson")
+OUTPUT_STREAM = None  # Where the records go, the rest of the output is on `stderr`.
+OUTPUT_RECORDS = 0
+STDOUT_COLORED = False
+STDERR_COLORED = False
+VALUED_OPTIONS = (
+    "--log-format",
+    "-j",
+    "--jobs",
+    "--plan-json",
+    "--interval",
+    "--keep-generations",
+    "--generation",
+    "--inventory",
+    "--transport",
+    "--local-path",
+    "--python",
+    "--stats-format",
+    "--prefetch-jobs",
+    "--diff-jobs",
+    "--format",
+)
+
+ANSWERS = {"force_manage": None}
+CONFIRM_LOCK = threading.RLock()
+
+OUTPUT_GROUP = threading.local()
+OUTPUT_LOCK = threading.Lock()
+
+SERVE_ALL = False
+SERVE_POLL = False
+SERVE_INTERVAL = 2.0
+SERVE_SETTLE_TIME = 0.5
+INOTIFY_EVENT_SIZE = 16  # struct inotify_event, without its name.
+INOTIFY_MASK = (
+    0x00000040  # IN_MOVED_FROM
+    | 0x00000080  # IN_MOVED_TO
+    | 0x00000100  # IN_CREATE
+    | 0x00000200  # IN_DELETE
+    | 0x00000400  # IN_DELETE_SELF
+    | 0x00000800  # IN_MOVE_SELF
+)
+INOTIFY_COUNTER_MASK = INOTIFY_MASK | 0x00000008  # IN_CLOSE_WRITE
+INOTIFY_OVERFLOW = 0x00004000  # IN_Q_OVERFLOW
+
+STATS = None
+STATS_FORMAT = "table"
+STATS_STARTED = None
+STATS_FORMATS = ("table", "json")
+STATS_CONTEXT = threading.local()
+STATS_LOCK = threading.Lock()
+# The stages to time, and whether their first argument is a formula or a dotfile.
+STATS_PHASES = {
+    "get_formula_info": "formula",
+    "yield_dotfiles": "formula",
+    "init_backups": "formula",
+    "archive_backups": "formula",
+    "plan_formula": "formula",
+    "execute_plan": "formula",
+    "plan_mount_dotfile": "dotfile",
+    "plan_unmount_dotfile": "dotfile",
+    "render_dotfile": "dotfile",
+    "status_dotfile": "dotfile",
+    "diff_dotfile": "dotfile",
+    "apply_op": "dotfile",
+}
+STATS_JUST_WIDTH = 22
+
+HOST_FLAG = "\uF108"  # Nerd Fonts: nf-fa-desktop
+FLEET_COMMANDS = ("order", "tab")
+FLEET_COMMAND = "tab"
+FLEET_INVENTORY = None
+FLEET_TRANSPORTS = ("ssh", "local")
+FLEET_TRANSPORT = "ssh"
+FLEET_LOCAL_PATH = None
+FLEET_ROOT = ".dotpub"  # Relative to the home directory of the remote user.
+FLEET_PYTHON = "python3"
+FLEET_JOBS = 8
+FLEET_TIMEOUT = 10 * 60
+FLEET_FINGERPRINT_FILENAME = ".payload-fingerprint"
+FLEET_SCRIPT_FILENAMES = ("publican.py", "dotpub.py", "completion.py")
+FLEET_SSH_OPTIONS = [
+    "-o",
+    "BatchMode=yes",
+    "-o",
+    "ConnectTimeout=10",
+    # Every step of a host goes through one connection, kept for the next run.
+    "-o",
+    "ControlMaster=auto",
+    "-o",
+    "ControlPersist=60",
+]
+FLEET_JUST_WIDTHS = (24, 12, 10, 10, 10)
+
+BREW_COMMAND = "info"
+BREW_TIMEOUT = 1 * 60 * 60
+BREW_BATCH_TIMEOUT = 2 * 60 * 60  # The cap of one batch invocation, however long.
+BREW_BATCH_SIZE = 20
+BREW_LINE_LIMIT = 1024 * 1024
+BREW_PARALLEL_COMMANDS = {
+    "info",
+    "fetch",
+    "desc",
+    "deps",
+    "uses",
+    "list",
+    "outdated",
+    "options",
+    "home",
+    "log",
+}
+BREW_COMMANDS = sorted(
+    BREW_PARALLEL_COMMANDS
+    | {"install", "uninstall", "reinstall", "upgrade", "link", "unlink", "pin", "unpin"}
+)
+BREW_PREFETCH_COMMANDS = {"install", "reinstall", "upgrade"}
+BREW_CACHED_COMMANDS = {"info", "list", "outdated", "desc", "deps", "options"}
+BREW_CACHE_TTL = 6 * 60 * 60
+BREW_CACHE_SIZE = 4096
+BREW_BATCH = False
+BREW_JOBS = 1
+BREW_PREFETCH = False
+BREW_PREFETCH_JOBS = 4
+BREW_REFRESH = False
+USE_TUNA_MIRROR = False
+
+
+# ==================================================
+# Utilities
+# ==================================================
+
+
+class ProgramError(Exception):
+    pass
+
+
+class GroupedStream:
+    """Stream proxy which holds back the output of a worker thread until it is done."""
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, text):
+        records = getattr(OUTPUT_GROUP, "records", None)
+        if records is None:
+            return self.stream.write(text)
+
+        records.append((self.stream, text))
+        return len(text)
+
+    def flush(self):
+        if getattr(OUTPUT_GROUP, "records", None) is None:
+            self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+def flush_records(records):
+    with OUTPUT_LOCK:
+        # Consecutive texts of the same stream are written at once.
+        for stream, group in itertools.groupby(records, key=lambda record: record[0]):
+            stream.write("".join(text for _, text in group))
+        for stream in {stream for stream, _ in records}:
+            stream.flush()
+
+
+@contextlib.contextmanager
+def grouped_streams():
+    """Route `stdout`, `stderr` and the logger streams through `GroupedStream`."""
+
+    origins = (sys.stdout, sys.stderr)
+    proxies = {origin: GroupedStream(origin) for origin in origins}
+    handlers = [
+        handler for handler in LOGGER.handlers if type(handler) is logging.StreamHandler
+    ]
+
+    sys.stdout, sys.stderr = proxies[origins[0]], proxies[origins[1]]
+    for handler in handlers:
+        if handler.stream in proxies:
+            handler.setStream(proxies[handler.stream])
+
+    try:
+        yield
+    finally:
+        sys.stdout, sys.stderr = origins
+        for handler in handlers:
+            if isinstance(handler.stream, GroupedStream):
+                handler.setStream(handler.stream.stream)
+
+
+@contextlib.contextmanager
+def grouped_output():
+    """Keep all output of current thread together, and print it at the end."""
+
+    OUTPUT_GROUP.records = []
+    try:
+        yield
+    finally:
+        records, OUTPUT_GROUP.records = OUTPUT_GROUP.records, None
+        flush_records(records)
+
+
+@contextlib.contextmanager
+def ungrouped_output():
+    """Release the pending output of current thread, e.g. before asking a question."""
+
+    with CONFIRM_LOCK:
+        records = getattr(OUTPUT_GROUP, "records", None)
+        if records is not None:
+            flush_records(records)
+            records.clear()
+            OUTPUT_GROUP.records = None
+
+        try:
+            yield
+        finally:
+            if records is not None:
+                OUTPUT_GROUP.records = records
+
+
+class JsonLinesStream:
+    """Stream proxy which turns the plain output lines into JSON-lines records."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.pending = ""
+
+    def write(self, text):
+        *lines, self.pending = (self.pending + text).split("\n")
+        self.stream.write("".join(self.convert(line) for line in lines))
+        return len(text)
+
+    def flush(self):
+        # A partial line is only flushed on purpose, e.g. the prompt of `input`.
+        if self.pending:
+            self.stream.write(self.convert(self.pending))
+            self.pending = ""
+        self.stream.flush()
+
+    @staticmethod
+    def convert(line):
+        prefix, separator, record = line.partition(LOG_RECORD_SEPARATOR)
+        if not separator:
+            return format_record("output", line) + "\n" if line.strip() else ""
+        if prefix:
+            # A label printed before a colored value, e.g. by `status_dotfile`.
+            record = json.loads(record)
+            record = format_record(record["level"], prefix + record["message"])
+        return record + "\n"
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+class ColoredFormatter(logging.Formatter):
+    """Formatter for the console handler, colored only if `stderr` is a terminal."""
+
+    def format(self, record):
+        return paint(super().format(record), record.levelno, STDERR_COLORED)
+
+
+class BackgroundHandler(logging.Handler):
+    """Hand the records over to a writer thread, so the caller never waits on disk."""
+
+    def __init__(self, handler):
+        super().__init__()
+        self.handler = handler
+        self.records = queue.SimpleQueue()
+        self.writer = None
+
+    def emit(self, record):
+        # Nothing is logged for most runs, so the thread is started on demand.
+        if self.writer is None:
+            self.writer = threading.Thread(target=self.write, daemon=True)
+            self.writer.start()
+        self.records.put(record)
+
+    def write(self):
+        while (record := self.records.get()) is not None:
+            self.handler.handle(record)
+
+    def close(self):
+        # Called by `logging.shutdown` at exit, after the pending records are written.
+        if self.writer is not None:
+            self.records.put(None)
+            self.writer.join()
+            self.writer = None
+        self.handler.close()
+        super().close()
+
+
+def paint(message, level, colored):
+    """Colored output by ANSI escape codes."""
+
+    return f"\033[3{LOG_COLORS[level]}m{message}\033[0m" if colored else message
+
+
+def format_record(level, message):
+    return json.dumps(
+        {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "level": level,
+            "message": message,
+        },
+        ensure_ascii=False,
+    )
+
+
+def log(message, level=NORMAL, disabled=False):
+    """Write one line of output, the records above `NORMAL` are logged too."""
+
+    if level > NORMAL and not disabled:
+        LOGGER.log(level, message)
+
+    if LOG_FORMAT == "json":
+        level_name = "normal" if level <= NORMAL else logging.getLevelName(level)
+        record = format_record(level_name.lower(), message)
+        sys.stdout.write(f"{LOG_RECORD_SEPARATOR}{record}\n")
+    elif level <= NORMAL or disabled:
+        sys.stdout.write(paint(message, level, STDOUT_COLORED) + "\n")
+
+
+def add_format_arguments(parser):
+    parser.add_argument(
+        "--format",
+        choices=OUTPUT_FORMATS,
+        default=OUTPUT_FORMAT,
+        help="print the results as a table, a JSON array or JSON lines, the records"
+        " take `stdout` and the rest goes to `stderr` (default: %(default)s)",
+    )
+
+    def pre_processor(args):
+        global OUTPUT_FORMAT, OUTPUT_STREAM, STDOUT_COLORED
+        OUTPUT_FORMAT = args.format
+        if OUTPUT_FORMAT == "table":
+            return
+
+        if isinstance(sys.stdout, JsonLinesStream):
+            OUTPUT_STREAM = sys.stdout.stream
+            sys.stdout = JsonLinesStream(sys.stderr)
+        else:
+            OUTPUT_STREAM = sys.stdout
+            sys.stdout = sys.stderr
+        STDOUT_COLORED = STDERR_COLORED
+
+    return pre_processor
+
+
+def emit_record(record):
+    """Write one result, a JSON line is flushed at once instead of waiting for the rest.
+
+    The records skip the grouped output, and a JSON array is written element by element,
+    so nothing is held back in memory whatever the number of formulae.
+    """
+
+    global OUTPUT_RECORDS
+    line = json.dumps(record, ensure_ascii=False)
+    with OUTPUT_LOCK:
+        if OUTPUT_FORMAT == "json":
+            line = ("[\n" if OUTPUT_RECORDS == 0 else ",\n") + line
+        else:
+            line += "\n"
+        OUTPUT_STREAM.write(line)
+        if OUTPUT_FORMAT == "ndjson":
+            OUTPUT_STREAM.flush()
+        OUTPUT_RECORDS += 1
+
+
+def close_records():
+    """End the JSON array, called even if the run fails partway so it stays valid."""
+
+    if OUTPUT_FORMAT == "json":
+        OUTPUT_STREAM.write("\n]\n" if OUTPUT_RECORDS else "[]\n")
+        OUTPUT_STREAM.flush()
+
+
+def get_brew_env():
+    my_env = os.environ.copy()
+
+    if USE_TUNA_MIRROR:
+        my_env[
+            "HOMEBREW_API_DOMAIN"
+        ] = "https://mirrors.tuna.tsinghua.edu.cn/homebrew-bottles/api/"
+        my_env[
+            "HOMEBREW_BOTTLE_DOMAIN"
+        ] = "https://mirrors.tuna.tsinghua.edu.cn/homebrew-bottles/"
+        my_env[
+            "HOMEBREW_BREW_GIT_REMOTE"
+        ] = "https://mirrors.tuna.tsinghua.edu.cn/git/homebrew/brew.git"
+        my_env[
+            "HOMEBREW_CORE_GIT_REMOTE"
+        ] = "https://mirrors.tuna.tsinghua.edu.cn/git/homebrew/homebrew-core.git"
+        my_env["HOMEBREW_PIP_INDEX_URL"] = "https://pypi.tuna.tsinghua.edu.cn/simple/"
+
+    return my_env
+
+
+def get_target_formulae(args):
+    if args.all:
+        return get_supported_formulae()
+
+    if args.formulae:
+        right, wrong = [], []
+        supported_formulae = set(get_supported_formulae())
+        for formula in args.formulae:
+            container = right if formula in supported_formulae else wrong
+            container.append(formula)
+
+        if wrong:
+            log(f"those formulae {wrong} are not supported.", logging.WARNING)
+        return right
+
+    log("please chose at last one formula to manage.", logging.ERROR)
+    raise ProgramError()
+
+
+def get_formula_info(formula):
+    info_path = COUNTER_PATH / formula / FORMULA_INFO_FILENAME
+
+    try:
+        info_stat = info_path.stat()
+        if (formula_info := load_formula_info(info_path, info_stat)) is not None:
+            return formula_info
+
+        with info_path.open() as fp:
+            formula_info = json.load(fp)
+
+        # Validate formula info.
+        message = "`path` should be a dict whit a glob pattern as key and a pathlike list (or a dict of it and its `mode`) as value"
+        path = formula_info["path"]
+        assert isinstance(path, dict), message
+        for key, value in path.items():
+            assert isinstance(key, str), message
+            if isinstance(value, dict):
+                mode = value.get("mode", DOTFILE_MODES[0])
+                assert mode in DOTFILE_MODES, f"`mode` should be one of {DOTFILE_MODES}"
+                message = "`directory` should be a bool, and only for the `link` mode"
+                directory = value.get("directory", False)
+                assert isinstance(directory, bool), message
+                assert not directory or mode == "link", message
+                value = value.get("path")
+            assert isinstance(value, list), message
+            for sub_value in value:
+                assert isinstance(sub_value, str), message
+        message = "`requires` should be a list of formula names"
+        requires = formula_info.get("requires", [])
+        assert isinstance(requires, list), message
+        for name in requires:
+            assert isinstance(name, str), message
+        # assert jsonschema.validate(formula_info, formula_info_schema), message
+
+    except FileNotFoundError:
+        log(f"{info_path}: file not found.", logging.ERROR)
+    except json.decoder.JSONDecodeError:
+        log(f"{info_path}: JSON decode error.", logging.ERROR)
+    except KeyError as e:
+        log(f"{info_path}: key {e} not found.", logging.ERROR)
+    except AssertionError as e:
+        log(f"{info_path}: format error, {e}.", logging.ERROR)
+
+    else:
+        dump_formula_info(info_path, info_stat, formula_info)
+        return formula_info
+
+    raise ProgramError()
+
+
+def request_confirm(question_flag):
+    with ungrouped_output():
+        # Another worker may have got a durable answer while we were waiting.
+        if ANSWERS[question_flag] is not None:
+            return ANSWERS[question_flag]
+        return ask_confirm(question_flag)
+
+
+def ask_confirm(question_flag):
+    message = """request confirm:
+    Y): yes, do it and no need asking again for the same question anyway.
+    y): yes, do it but just for this time.
+    N): no, don't do it and no need asking again for the same question anyway.
+    n): no, don't do it but just for this time.
+    exit): exit, I will check it by myself.
+(type your answer then press <Enter>): """
+    answer = input(message)
+
+    if answer == "exit":
+        log(f"program exited by user.", logging.INFO)
+        exit(0)
+    elif answer == "Y":
+        ANSWERS[question_flag] = True
+        return True
+    elif answer == "y":
+        return True
+    elif answer == "N":
+        ANSWERS[question_flag] = False
+        return False
+    elif answer == "n":
+        return False
+    else:
+        log(f"{answer}: unknown input, please type again.", logging.WARNING)
+        return ask_confirm(question_flag)
+
+
+def init_backups(formula):
+    """Empty the backups of a formula, they are archived as a generation first."""
+
+    backup_dir_path = BACKUPS_PATH / formula
+    backup_dir_path.mkdir(parents=True, exist_ok=True)
+    archive_backups(formula)
+    clear_backups(backup_dir_path)
+
+
+def split_path_value(value):
+    """Split a value of the path section into its segments, its mode and `directory`."""
+
+    if isinstance(value, dict):
+        mode = value.get("mode", DOTFILE_MODES[0])
+        return value["path"], mode, value.get("directory", False)
+    return value, DOTFILE_MODES[0], False
+
+
+def path_resolver(path_segments: list[str]):
+    """Turn the path segments into a directory, the segments are left untouched."""
+
+    return resolve_path_segments(tuple(path_segments))
+
+
+@functools.lru_cache(maxsize=None)
+def resolve_path_segments(path_segments):
+    # Most formulae share a handful of directories, each is resolved once per run.
+    try:
+        segments = [expand_variables(segment) for segment in path_segments]
+    except KeyError as e:
+        log(
+            f"${e.args[0]}: unknown environment variable, please checkout your path section specified in {FORMULA_INFO_FILENAME}.",
+            logging.WARNING,
+        )
+        return None
+
+    return pathlib.Path(*segments).expanduser()
+
+
+def lookup_variable(name, default, expand):
+    value = os.environ.get(name)
+    # As in shell, `:-` falls back on the default if unset or empty.
+    if default is not None and not value:
+        return expand(default)
+    if value is None:
+        raise KeyError(name)
+    return value
+
+
+def expand_variables(text):
+    """Expand `$VAR`, `${VAR}` and `${VAR:-default}`, raise `KeyError` if unset."""
+
+    def replace(match):
+        return lookup_variable(match[1] or match[3], match[2], expand_variables)
+
+    return PATH_VARIABLE_PATTERN.sub(replace, text)
+
+
+def expand_template(text):
+    """Expand `${VAR}` and `${VAR:-default}` in a template, `$$` is a literal `$`.
+
+    A bare `$VAR` is left as it is, e.g. `$1` or `$PS1` in a shell rc file.
+    """
+
+    def replace(match):
+        if match[3]:
+            return "$"
+        return lookup_variable(match[1], match[2], expand_template)
+
+    return TEMPLATE_VARIABLE_PATTERN.sub(replace, text)
+
+
+def get_template_variables(text):
+    return {match[1] for match in TEMPLATE_VARIABLE_PATTERN.finditer(text) if match[1]}
+
+
+def get_path_variables(path_segments):
+    return {
+        match[1] or match[3]
+        for segment in path_segments
+        for match in PATH_VARIABLE_PATTERN.finditer(segment)
+    }
+
+
+@functools.lru_cache(maxsize=None)
+def resolve_dir(dir_path):
+    return dir_path.resolve()
+
+
+def resolve_path(path):
+    """Same as `path.resolve()`, but the parent directories are resolved once."""
+
+    for _ in range(PATH_MAX_SYMLINKS):
+        if path.name in ("", ".", ".."):
+            break
+        path = resolve_dir(path.parent) / path.name
+        count_fs_op("readlink")
+        try:
+            target = os.readlink(path)
+        except OSError:
+            return path
+        path = path.parent / target
+
+    return path.resolve()
+
+
+@functools.lru_cache(maxsize=None)
+def compile_pattern(pattern):
+    """Compile a glob pattern of one path component, `None` if it spans more."""
+
+    if "/" in pattern or pattern in (".", "..") or "**" in pattern:
+        return None
+    return re.compile(fnmatch.translate(pattern)).match
+
+
+def translate_segment(segment):
+    """Translate one component of a glob pattern as `fnmatch`, but never across a `/`."""
+
+    parts, index = [], 0
+    while index < len(segment):
+        char, index = segment[index], index + 1
+        if char == "*":
+            parts.append("[^/]*")
+        elif char == "?":
+            parts.append("[^/]")
+        elif char == "[" and (end := segment.find("]", index + 1)) != -1:
+            chars, index = segment[index:end].replace("\\", "\\\\"), end + 1
+            if chars.startswith("!"):
+                chars = "^" + chars[1:]
+            parts.append(f"[{chars}]")
+        else:
+            parts.append(re.escape(char))
+    return "".join(parts)
+
+
+@functools.lru_cache(maxsize=None)
+def compile_recursive_pattern(pattern):
+    """Split a `**` pattern into the directory to walk and a matcher of the paths in it.
+
+    E.g. `nvim/**/*.lua` walks `nvim/` and matches `init.lua` or `lua/plugins/lsp.lua`.
+    """
+
+    segments = [segment for segment in pattern.split("/") if segment not in ("", ".")]
+    base = []
+    while len(segments) > 1 and not any(char in segments[0] for char in "*?["):
+        base.append(segments.pop(0))
+
+    parts = []
+    for index, segment in enumerate(segments):
+        last = index == len(segments) - 1
+        if segment == "**":
+            parts.append(".*" if last else "(?:[^/]+/)*")
+            continue
+
+        part = translate_segment(segment)
+        parts.append(part if last else f"{part}/")
+
+    return "/".join(base), re.compile("".join(parts) + r"\Z", re.S).match
+
+
+def scan_counter_dir(counter_dir_path):
+    """List the counter directory once, each entry caches its own file type."""
+
+    count_fs_op("scandir")
+    with os.scandir(counter_dir_path) as entries:
+        return list(entries)
+
+
+def yield_dotfiles(formula, formula_info):
+    counter_dir_path = COUNTER_PATH / formula
+    real_dir_path = counter_dir_path.resolve()
+    is_inside = str(real_dir_path).startswith(str(counter_dir_path))
+    entries = None
+
+    yielded_dotfiles = set()
+    for pattern, value in formula_info.get("path", {}).items():
+        path_segments, mode, directory = split_path_value(value)
+        if (system_dir_path := path_resolver(path_segments)) is None:
+            continue
+
+        # The `**` patterns keep the relative paths, the others flatten them by name.
+        base = ""
+        if "**" in pattern:
+            base, matcher = compile_recursive_pattern(pattern)
+            # The base is walked as it is, it must not lead out of the formula.
+            walk_dir_path = (real_dir_path / base).resolve()
+            if ".." in base.split("/") or not walk_dir_path.is_relative_to(
+                real_dir_path
+            ):
+                log(
+                    f"{counter_dir_path / base}: outside dotfile, please checkout your path specified in {FORMULA_INFO_FILENAME}.",
+                    logging.WARNING,
+                )
+                continue
+            candidates = yield_walked_dotfiles(
+                walk_dir_path, matcher, is_inside, mode, directory
+            )
+        elif (matcher := compile_pattern(pattern)) is None:
+            candidates = yield_globbed_dotfiles(
+                counter_dir_path, pattern, mode, directory
+            )
+        else:
+            if entries is None:
+                entries = scan_counter_dir(counter_dir_path)
+            candidates = yield_scanned_dotfiles(
+                entries, matcher, real_dir_path, is_inside, mode, directory
+            )
+
+        for counter_path, inside, relative in candidates:
+            if counter_path in yielded_dotfiles:
+                log(
+                    f"{counter_path}: duplicate dotfile, please checkout your path section specified in {FORMULA_INFO_FILENAME}.",
+                    logging.WARNING,
+                )
+                continue
+
+            if not inside:
+                log(
+                    f"{counter_path}: outside dotfile, please checkout your path specified in {FORMULA_INFO_FILENAME}.",
+                    logging.WARNING,
+                )
+                continue
+
+            yielded_dotfiles.add(counter_path)
+
+            system_path = system_dir_path / relative
+            backup_path = BACKUPS_PATH / formula / base / relative
+
+            yield {
+                "counter": counter_path,
+                "system": system_path,
+                "backup": backup_path,
+                "mode": mode,
+            }
+
+
+def yield_scanned_dotfiles(entries, matcher, real_dir_path, is_inside, mode, directory):
+    """Match the scanned entries against one pattern, without any more syscall."""
+
+    for entry in entries:
+        if entry.name == ".DS_Store" or entry.name == FORMULA_INFO_FILENAME:
+            continue
+        if not matcher(entry.name):
+            continue
+        if entry.is_dir() and not (directory and not entry.is_symlink()):
+            continue
+
+        # A copy is read through the link, only a symlink to a symlink is confusing.
+        if entry.is_symlink() and mode == "link":
+            log(
+                f"{entry.path}: symlinked dotfile is not supported",
+                logging.WARNING,
+            )
+            continue
+
+        yield real_dir_path / entry.name, is_inside, entry.name
+
+
+def yield_globbed_dotfiles(counter_dir_path, pattern, mode, directory):
+    """Match the pattern spanning several path components via `glob`."""
+
+    for counter_path in counter_dir_path.glob(pattern):
+        if counter_path.match(".DS_Store"):
+            continue
+        if counter_path.match(FORMULA_INFO_FILENAME):
+            continue
+        if counter_path.is_dir() and not (directory and not counter_path.is_symlink()):
+            continue
+
+        if counter_path.is_symlink():
+            if mode == "link":
+                log(
+                    f"{counter_path}: symlinked dotfile is not supported",
+                    logging.WARNING,
+                )
+                continue
+        else:
+            counter_path = resolve_path(counter_path)
+
+        inside = str(counter_path).startswith(str(counter_dir_path))
+        yield counter_path, inside, counter_path.name
+
+
+def yield_walked_dotfiles(dir_path, matcher, is_inside, mode, directory):
+    """Walk the directory lazily, only the directories being walked are kept open.
+
+    With `directory` a matched directory is yielded as a whole, instead of its files.
+    """
+
+    stack = []
+    count_fs_op("scandir")
+    try:
+        stack.append(("", os.scandir(dir_path)))
+    except OSError:
+        return
+
+    try:
+        while stack:
+            prefix, entries = stack[-1]
+            if (entry := next(entries, None)) is None:
+                stack.pop()[1].close()
+                continue
+
+            relative = prefix + entry.name
+            if entry.name == ".DS_Store" or relative == FORMULA_INFO_FILENAME:
+                continue
+
+            if entry.is_dir(follow_symlinks=False):
+                if directory and matcher(relative):
+                    yield dir_path / relative, is_inside, relative
+                    continue
+                count_fs_op("scandir")
+                try:
+                    stack.append((f"{relative}/", os.scandir(entry.path)))
+                except OSError as e:
+                    log(f"{entry.path}: walk error, {e}.", logging.WARNING)
+                continue
+
+            if not matcher(relative):
+                continue
+
+            if entry.is_symlink() and mode == "link":
+                log(
+                    f"{entry.path}: symlinked dotfile is not supported",
+                    logging.WARNING,
+                )
+                continue
+
+            yield dir_path / relative, is_inside, relative
+    finally:
+        for _, entries in stack:
+            entries.close()
+
+
+def render_dotfile(counter, mode):
+    """Get the content a copied dotfile should have, a template sees the environment."""
+
+    content = counter.read_bytes()
+    if mode == "template":
+        content = expand_template(content.decode()).encode()
+    return content
+
+
+def hash_content(content):
+    import hashlib
+
+    return hashlib.sha256(content).hexdigest()
+
+
+def hash_file(path):
+    """Hash a file in chunks, a large one is mapped instead of being read.
+
+    The digest releases the GIL on each chunk, so the files can be hashed in threads.
+    """
+
+    import hashlib
+    import mmap
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as fp:
+        size = os.fstat(fp.fileno()).st_size
+        if size <= HASH_CHUNK_SIZE:
+            digest.update(fp.read())
+            return digest.hexdigest()
+
+        with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            with memoryview(mapped) as view:
+                for offset in range(0, len(view), HASH_CHUNK_SIZE):
+                    digest.update(view[offset : offset + HASH_CHUNK_SIZE])
+    return digest.hexdigest()
+
+
+def has_content(path, content):
+    """Whether the regular file holds the content, the sizes are compared first."""
+
+    path_stat = lstat_path(path)
+    if path_stat is None or not stat.S_ISREG(path_stat.st_mode):
+        return False
+    return path_stat.st_size == len(content) and hash_file(path) == hash_content(
+        content
+    )
+
+
+def write_dotfile(path, content, source):
+    """Replace the file atomically, it takes the permission bits of the source."""
+
+    temp_path = path.with_name(f".{path.name}.{threading.get_ident()}.tmp")
+    try:
+        with open(temp_path, "wb") as fp:
+            fp.write(content)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.chmod(temp_path, stat.S_IMODE(os.stat(source).st_mode))
+        os.replace(temp_path, path)
+    except BaseException:
+        temp_path.unlink(missing_ok=True)
+        raise
+
+
+def positive_int(value):
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"{value}: should be a positive integer")
+    return number
+
+
+def run_formula(action, formula):
+    """Run the action for one formula, and report its failure instead of raising."""
+
+    with grouped_output():
+        try:
+            action(formula)
+        except ProgramError:
+            pass
+        except OSError as e:
+            log(f"{formula}: {e}.", logging.ERROR)
+        else:
+            return True
+
+        log(f"{formula}: failed.", logging.ERROR)
+        print("")
+        return False
+
+
+def get_formula_graph(formulae, reverse=False):
+    """Map the formulae, and those they require indirectly, to the formulae before them.
+
+    With `reverse` the edges are turned around, a formula comes after those require it.
+    The formulae whose info can not be loaded are returned as well, they fail alone.
+    """
+
+    supported_formulae = set(get_supported_formulae())
+    graph, broken, pending = {}, set(), list(formulae)
+    while pending:
+        if (formula := pending.pop()) in graph:
+            continue
+
+        try:
+            graph[formula] = get_formula_info(formula).get("requires", [])
+        except ProgramError:
+            graph[formula] = []
+            broken.add(formula)
+            continue
+        if unknown := sorted(set(graph[formula]) - supported_formulae):
+            log(f"{formula}: requires unsupported formulae {unknown}.", logging.ERROR)
+            graph[formula] = []
+            broken.add(formula)
+            continue
+        pending.extend(graph[formula])
+
+    if reverse:
+        reversed_graph = {formula: [] for formula in graph}
+        for formula, requires in graph.items():
+            for name in requires:
+                reversed_graph[name].append(formula)
+        graph = reversed_graph
+
+    # Find the cycles up front, instead of getting stuck in the middle of a run.
+    try:
+        graphlib.TopologicalSorter(graph).prepare()
+    except graphlib.CycleError as e:
+        log(f"those formulae {e.args[1]} require each other.", logging.ERROR)
+        raise ProgramError()
+
+    return graph, broken
+
+
+def sort_formulae(formulae, reverse=False):
+    """Sort the formulae so that every formula comes after those it requires."""
+
+    targets = set(formulae)
+    graph, _ = get_formula_graph(formulae, reverse)
+    sorter = graphlib.TopologicalSorter(graph)
+    sorter.prepare()
+
+    order = []
+    while sorter.is_active():
+        ready = sorted(sorter.get_ready())
+        order.extend(formula for formula in ready if formula in targets)
+        sorter.done(*ready)
+    return order
+
+
+def run_concurrently(action, formulae, jobs, reverse=False, graph=None):
+    """Run the action in a bounded thread pool, a formula starts after those it requires.
+
+    The formulae after a failed one are skipped, even if it was not a target itself.
+    A `graph` replaces the requirements, e.g. the hosts of `fleet` wait for nothing.
+    """
+
+    import concurrent.futures
+
+    broken = set()
+    if graph is None:
+        graph, broken = get_formula_graph(formulae, reverse)
+    sorter = graphlib.TopologicalSorter(graph)
+    sorter.prepare()
+
+    targets, results, futures = set(formulae), {}, {}
+    with grouped_streams():
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+        try:
+            while sorter.is_active():
+                for formula in sorted(sorter.get_ready()):
+                    blocked = [name for name in graph[formula] if not results[name]]
+                    if formula in broken:
+                        # Its info is already reported, only those after it wait on it.
+                        with grouped_output():
+                            log(f"{formula}: failed.", logging.ERROR)
+                            print("")
+                        results[formula] = False
+                        sorter.done(formula)
+                        continue
+
+                    if formula in targets and not blocked:
+                        future = executor.submit(run_formula, action, formula)
+                        futures[future] = formula
+                        continue
+
+                    if formula in targets:
+                        with grouped_output():
+                            log(f"{formula}: skipped, {blocked} failed.", logging.ERROR)
+                            print("")
+                    results[formula] = formula not in targets and not blocked
+                    sorter.done(formula)
+
+                if futures:
+                    done, _ = concurrent.futures.wait(
+                        futures, return_when=concurrent.futures.FIRST_COMPLETED
+                    )
+                    for future in done:
+                        formula = futures.pop(future)
+                        results[formula] = future.result()
+                        sorter.done(formula)
+        finally:
+            executor.shutdown(cancel_futures=True)
+
+    failed = [formula for formula in formulae if not results[formula]]
+    if failed:
+        log(f"those formulae {failed} are failed.", logging.ERROR)
+        raise ProgramError()
+
+
+def add_sub_parser(subparsers, action):
+    """Create the parser of an action, the stub of it is enough to be listed in help."""
+
+    description = ACTIONS[action]
+    return subparsers.add_parser(
+        action,
+        description=description,
+        help=description[0].lower() + description[1:].rstrip("."),
+    )
+
+
+def build_common_cmd(
+    parser,
+    action,
+    pre_processor=None,
+    post_processor=None,
+    concurrent=False,
+    bulk=False,
+    ordered=False,
+    reverse=False,
+):
+    """Add the common arguments, with `bulk` the action takes all formulae at once.
+
+    With `ordered` a formula is handled after those it requires, or before them if
+    `reverse` is also given, and `--jobs` runs the independent formulae in parallel.
+    """
+
+    parser.add_argument(
+        "formulae",
+        type=str,
+        nargs="*",
+        metavar="FORMULAE",
+        # choices=SUPPORTED_FORMULAE,
+        help="chose the formulae those you want to manage",
+    )
+    parser.add_argument(
+        "-a",
+        "--all",
+        action="store_true",
+        help="manage all of the formulae those be supported default",
+    )
+    if concurrent:
+        parser.add_argument(
+            "-j",
+            "--jobs",
+            type=positive_int,
+            default=1,
+            metavar="N",
+            help="manage up to N independent formulae at the same time",
+        )
+
+    def handler(args):
+        if pre_processor is not None:
+            pre_processor(args)
+
+        try:
+            formulae = get_target_formulae(args)
+            jobs = 1 if bulk else getattr(args, "jobs", 1)
+            # The pool follows the requirements by itself, as the formulae finish.
+            if ordered and jobs == 1:
+                formulae = sort_formulae(formulae, reverse)
+
+            if bulk:
+                action(formulae)
+            elif jobs > 1:
+                run_concurrently(action, formulae, jobs, reverse)
+            else:
+                # Each formula is written at once, instead of line by line.
+                with grouped_streams():
+                    for formula in formulae:
+                        with grouped_output():
+                            action(formula)
+        finally:
+            close_records()
+
+        if post_processor is not None:
+            post_processor(args)
+
+    parser.set_defaults(formulae=[], handler=handler)
+    return parser
+
+
+# ==================================================
+# Databases
+# ==================================================
+
+
+def connect_database(database_path):
+    import sqlite3
+
+    connection = sqlite3.connect(
+        str(database_path), timeout=30, check_same_thread=False
+    )
+    connection.execute("PRAGMA journal_mode = WAL")
+    connection.execute("PRAGMA synchronous = NORMAL")
+
+    (version,) = connection.execute("PRAGMA user_version").fetchone()
+    if version != DATABASE_VERSION:
+        # Everything stored here can be derived again, so just start over.
+        tables = connection.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table'"
+        ).fetchall()
+        for (table,) in tables:
+            connection.execute(f"DROP TABLE IF EXISTS {table}")
+        connection.executescript(DATABASE_SCHEMA)
+        connection.execute(f"PRAGMA user_version = {DATABASE_VERSION}")
+        connection.commit()
+
+    return connection
+
+
+def get_database():
+    """Open the local database lazily, the connection is shared by all threads."""
+
+    import sqlite3
+
+    global DATABASE
+    if DATABASE is None:
+        database_path = DATABASES_PATH / DATABASE_FILENAME
+        DATABASES_PATH.mkdir(parents=True, exist_ok=True)
+        try:
+            DATABASE = connect_database(database_path)
+        except sqlite3.DatabaseError:
+            log(f"{database_path}: broken database, rebuild it.", logging.WARNING)
+            database_path.unlink(missing_ok=True)
+            DATABASE = connect_database(database_path)
+
+    return DATABASE
+
+
+def query_database(sql, parameters=()):
+    """Fetch all rows of the query, or nothing if the database is unavailable."""
+
+    import sqlite3
+
+    with DATABASE_LOCK:
+        try:
+            return get_database().execute(sql, parameters).fetchall()
+        except (sqlite3.Error, OSError) as e:
+            log(f"{DATABASE_FILENAME}: query error, {e}.", logging.WARNING)
+            return []
+
+
+def update_database(*statements):
+    """Execute the `(sql, parameters)` statements in one transaction."""
+
+    import sqlite3
+
+    with DATABASE_LOCK:
+        try:
+            database = get_database()
+            with database:
+                for sql, parameters in statements:
+                    database.execute(sql, parameters)
+        except (sqlite3.Error, OSError) as e:
+            log(f"{DATABASE_FILENAME}: update error, {e}.", logging.WARNING)
+
+
+def get_supported_formulae():
+    global SUPPORTED_FORMULAE
+    if SUPPORTED_FORMULAE is None:
+        SUPPORTED_FORMULAE = load_supported_formulae()
+    return SUPPORTED_FORMULAE
+
+
+def load_supported_formulae():
+    """List the formulae in `counter/`, the list is cached until its mtime changes."""
+
+    mtime_ns = str(COUNTER_PATH.stat().st_mtime_ns)
+
+    rows = query_database("SELECT value FROM meta WHERE key = 'counter_mtime_ns'")
+    if rows == [(mtime_ns,)]:
+        rows = query_database("SELECT name FROM formulae ORDER BY name")
+        return [name for (name,) in rows]
+
+    formulae = sorted(
+        [child.name for child in COUNTER_PATH.iterdir() if child.is_dir()]
+    )
+    update_database(
+        ("DELETE FROM formulae", ()),
+        *[("INSERT INTO formulae (name) VALUES (?)", (name,)) for name in formulae],
+        (
+            "INSERT OR REPLACE INTO meta (key, value) VALUES ('counter_mtime_ns', ?)",
+            (mtime_ns,),
+        ),
+    )
+    dump_completion_index(formulae)
+    return formulae
+
+
+def dump_completion_index(formulae):
+    """Write everything `complete` needs, so it never has to parse the arguments."""
+
+    index = {
+        "counter_mtime_ns": [str(COUNTER_PATH.stat().st_mtime_ns)],
+        "script_mtime_ns": [str(pathlib.Path(__file__).stat().st_mtime_ns)],
+        "actions": list(ACTIONS),
+        "commands": BREW_COMMANDS,
+        "valued": list(VALUED_OPTIONS),
+        "formulae": formulae,
+    }
+    index_path = DATABASES_PATH / COMPLETION_INDEX_FILENAME
+    temp_path = index_path.with_name(f"{index_path.name}.tmp")
+    try:
+        temp_path.write_text(
+            "".join("\t".join([key, *values]) + "\n" for key, values in index.items()),
+            encoding="utf-8",
+        )
+        temp_path.replace(index_path)
+    except OSError as e:
+        log(f"{COMPLETION_INDEX_FILENAME}: update error, {e}.", logging.WARNING)
+
+
+def load_formula_info(info_path, info_stat):
+    """Get the cached formula info, if the file did not change since it was parsed."""
+
+    rows = query_database(
+        "SELECT info FROM formula_info WHERE path = ? AND mtime_ns = ? AND size = ?",
+        (str(info_path), info_stat.st_mtime_ns, info_stat.st_size),
+    )
+    return json.loads(rows[0][0]) if rows else None
+
+
+def dump_formula_info(info_path, info_stat, formula_info):
+    update_database(
+        (
+            "INSERT OR REPLACE INTO formula_info (path, mtime_ns, size, info) VALUES (?, ?, ?, ?)",
+            (
+                str(info_path),
+                info_stat.st_mtime_ns,
+                info_stat.st_size,
+                json.dumps(formula_info),
+            ),
+        )
+    )
+
+
+def get_brew_result_key(cmd):
+    """Key a brew query by its arguments and the `HOMEBREW_*` mirror settings."""
+
+    import hashlib
+
+    env = sorted(
+        (key, value)
+        for key, value in get_brew_env().items()
+        if key.startswith("HOMEBREW_")
+    )
+    return hashlib.sha256(json.dumps([cmd, env]).encode()).hexdigest()
+
+
+def load_brew_result(cmd):
+    """Get the cached output of a read-only brew command, unless it expired."""
+
+    if BREW_REFRESH:
+        return None
+
+    key, now = get_brew_result_key(cmd), time.time()
+    rows = query_database(
+        "SELECT output FROM brew_results WHERE key = ? AND created > ?",
+        (key, now - BREW_CACHE_TTL),
+    )
+    if not rows:
+        return None
+
+    update_database(
+        ("UPDATE brew_results SET accessed = ? WHERE key = ?", (now, key)),
+    )
+    return rows[0][0]
+
+
+def dump_brew_results(results):
+    """Cache the `(cmd, output)` results, the least recently used ones are evicted."""
+
+    now = time.time()
+    update_database(
+        *[
+            (
+                "INSERT OR REPLACE INTO brew_results (key, bottle, created, accessed, output) VALUES (?, ?, ?, ?, ?)",
+                (get_brew_result_key(cmd), cmd[-1], now, now, output),
+            )
+            for cmd, output in results
+        ],
+        ("DELETE FROM brew_results WHERE created <= ?", (now - BREW_CACHE_TTL,)),
+        (
+            "DELETE FROM brew_results WHERE key NOT IN (SELECT key FROM brew_results ORDER BY accessed DESC LIMIT ?)",
+            (BREW_CACHE_SIZE,),
+        ),
+    )
+
+
+def forget_brew_results(bottles=None):
+    """Drop the cached results of the bottles, or all of them, once brew changed them."""
+
+    if bottles is None:
+        update_database(("DELETE FROM brew_results", ()))
+    else:
+        update_database(
+            *[("DELETE FROM brew_results WHERE bottle = ?", (b,)) for b in bottles]
+        )
+
+
+def lstat_path(path):
+    count_fs_op("lstat")
+    try:
+        return os.lstat(path)
+    except OSError:
+        return None
+
+
+def stat_fingerprint(path_stat):
+    if path_stat is None:
+        return ""
+    return ":".join(
+        str(value)
+        for value in (
+            path_stat.st_ino,
+            path_stat.st_mode,
+            path_stat.st_size,
+            path_stat.st_mtime_ns,
+        )
+    )
+
+
+def probe_dotfile(counter, system, backup, target=None, mode="link"):
+    """Probe the status of a dotfile, the known link `target` saves a `resolve()`.
+
+    The `target` of a copied dotfile is the digest of its content instead.
+    """
+
+    system_stat, backup_stat = lstat_path(system), lstat_path(backup)
+    state = {
+        "system": str(system),
+        "counter": str(counter),
+        "backup": str(backup),
+        "target": "",
+        "system_fingerprint": stat_fingerprint(system_stat),
+        "backup_fingerprint": stat_fingerprint(backup_stat),
+    }
+
+    if system_stat is None:
+        state["system_status"] = "not-exists"
+    elif mode != "link" and stat.S_ISREG(system_stat.st_mode):
+        state["target"] = target or hash_file(system)
+        state["system_status"] = get_copy_status(counter, system, mode, state["target"])
+    elif mode != "link" and stat.S_ISLNK(system_stat.st_mode):
+        state["target"] = str(resolve_path(system))
+        state["system_status"] = "not-mounted"
+    elif (
+        stat.S_ISLNK(system_stat.st_mode)
+        or stat.S_ISREG(system_stat.st_mode)
+        or stat.S_ISDIR(system_stat.st_mode)
+        and counter.is_dir()
+    ):
+        if target is None or not stat.S_ISLNK(system_stat.st_mode):
+            target = resolve_path(system)
+        state["target"] = str(target)
+        state["system_status"] = "mounted" if target == counter else "not-mounted"
+    else:
+        state["system_status"] = "unknown-file"
+
+    if backup_stat is None:
+        state["backup_status"] = "not-exists"
+    elif stat.S_ISLNK(backup_stat.st_mode) or stat.S_ISREG(backup_stat.st_mode):
+        state["backup_status"] = "backed-up"
+    elif stat.S_ISDIR(backup_stat.st_mode) and counter.is_dir():
+        state["backup_status"] = "backed-up"
+    else:
+        state["backup_status"] = "unknown-file"
+
+    return state
+
+
+def get_copy_status(counter, system, mode, digest):
+    """Tell a copy still as rendered, from one changed in place since it was written."""
+
+    previous = load_dotfile_state(system)
+    if previous is not None and previous["counter"] == str(counter):
+        if previous["system_status"] == "mounted" and previous["target"] == digest:
+            return "mounted"
+
+    try:
+        if digest == hash_content(render_dotfile(counter, mode)):
+            return "mounted"
+    except (KeyError, OSError, UnicodeDecodeError):
+        pass
+
+    if previous is not None and previous["counter"] == str(counter):
+        if previous["system_status"] in ("mounted", "modified"):
+            return "modified"
+    return "not-mounted"
+
+
+def record_dotfile(counter, system, backup, target=None, mode="link"):
+    """Record the status of a dotfile after its mount or unmount."""
+
+    state = probe_dotfile(counter, system, backup, target, mode)
+    # A dry run only plans, even the status database is left as it was.
+    if not DRY_RUN:
+        update_database(get_record_statement(state))
+    return state
+
+
+def get_record_statement(state):
+    return (
+        f"INSERT OR REPLACE INTO mount_state ({', '.join(MOUNT_STATE_COLUMNS)}) "
+        f"VALUES ({', '.join('?' * len(MOUNT_STATE_COLUMNS))})",
+        tuple(state[column] for column in MOUNT_STATE_COLUMNS),
+    )
+
+
+def fingerprint_formula(formula, formula_info):
+    """Fingerprint what the mounts of a formula depend on, its files and its paths."""
+
+    import hashlib
+
+    digest = hashlib.sha1()
+    # Any pattern may reach into a nested directory, so the whole tree is walked.
+    counter_dir_path = COUNTER_PATH / formula
+    for dir_path, dir_names, file_names in os.walk(counter_dir_path):
+        dir_names.sort()
+        for name in sorted(file_names) + dir_names:
+            with contextlib.suppress(OSError):
+                entry_path = os.path.join(dir_path, name)
+                entry_stat = os.lstat(entry_path)
+                relative = os.path.relpath(entry_path, counter_dir_path)
+                digest.update(
+                    f"{relative}:{entry_stat.st_mode}:{entry_stat.st_mtime_ns}\n".encode()
+                )
+
+    path = formula_info.get("path", {})
+
+    variables = {
+        variable
+        for value in path.values()
+        for variable in get_path_variables(split_path_value(value)[0])
+    }
+    # The rendered templates change with the variables they use.
+    for pattern, value in path.items():
+        if split_path_value(value)[1] == "template":
+            for counter_path in (COUNTER_PATH / formula).glob(pattern):
+                with contextlib.suppress(OSError, UnicodeDecodeError):
+                    variables |= get_template_variables(counter_path.read_text())
+    variables = sorted(variables)
+    environment = {variable: os.environ.get(variable) for variable in variables}
+    digest.update(
+        json.dumps(
+            [path, environment, os.path.expanduser("~"), str(BACKUPS_PATH)],
+            sort_keys=True,
+        ).encode()
+    )
+    return digest.hexdigest()
+
+
+def is_formula_up_to_date(formula, fingerprint):
+    """Whether the formula is mounted by a previous run and nothing changed since."""
+
+    rows = query_database(
+        "SELECT fingerprint, systems FROM formula_state WHERE formula = ?", (formula,)
+    )
+    if not rows or rows[0][0] != fingerprint:
+        return False
+
+    systems = json.loads(rows[0][1])
+    states = dict(
+        query_database(
+            "SELECT system, system_fingerprint FROM mount_state "
+            f"WHERE system_status = 'mounted' AND system IN ({', '.join('?' * len(systems))})",
+            systems,
+        )
+    )
+    return all(
+        states.get(system) == stat_fingerprint(lstat_path(system)) for system in systems
+    )
+
+
+def record_formula(formula, fingerprint, systems):
+    """Record the formula as up to date, if all of its dotfiles are mounted."""
+
+    systems = [str(system) for system in systems]
+    mounted = query_database(
+        "SELECT COUNT(*) FROM mount_state "
+        f"WHERE system_status = 'mounted' AND system IN ({', '.join('?' * len(systems))})",
+        systems,
+    )
+    if mounted != [(len(systems),)]:
+        return forget_formula(formula)
+
+    update_database(
+        (
+            "INSERT OR REPLACE INTO formula_state (formula, fingerprint, systems) VALUES (?, ?, ?)",
+            (formula, fingerprint, json.dumps(systems)),
+        )
+    )
+
+
+def forget_formula(formula):
+    update_database(("DELETE FROM formula_state WHERE formula = ?", (formula,)))
+
+
+def load_dotfile_state(system):
+    rows = query_database(
+        f"SELECT {', '.join(MOUNT_STATE_COLUMNS)} FROM mount_state WHERE system = ?",
+        (str(system),),
+    )
+    return dict(zip(MOUNT_STATE_COLUMNS, rows[0])) if rows else None
+
+
+def load_dotfile_states(systems):
+    systems = [str(system) for system in systems]
+    rows = query_database(
+        f"SELECT {', '.join(MOUNT_STATE_COLUMNS)} FROM mount_state "
+        f"WHERE system IN ({', '.join('?' * len(systems))})",
+        systems,
+    )
+    return {row[0]: dict(zip(MOUNT_STATE_COLUMNS, row)) for row in rows}
+
+
+def is_dotfile_state_fresh(state, counter, system, backup):
+    """Whether the recorded status still holds, i.e. none of its files changed."""
+
+    return (
+        state is not None
+        and state["counter"] == str(counter)
+        and state["backup"] == str(backup)
+        and state["system_fingerprint"] == stat_fingerprint(lstat_path(system))
+        and state["backup_fingerprint"] == stat_fingerprint(lstat_path(backup))
+    )
+
+
+def forget_dotfiles(systems):
+    update_database(
+        *[("DELETE FROM mount_state WHERE system = ?", (system,)) for system in systems]
+    )
+
+
+def get_dotfile_state(counter, system, backup, verify=False, mode="link"):
+    """Get the recorded status of a dotfile, probe it again only if it changed since."""
+
+    if not verify:
+        state = load_dotfile_state(system)
+        if is_dotfile_state_fresh(state, counter, system, backup):
+            return state
+
+    return record_dotfile(counter, system, backup, mode=mode)
+
+
+# ==================================================
+# Journals
+# ==================================================
+
+
+def fsync_dir(dir_path):
+    fd = os.open(dir_path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def get_journal_path(formula):
+    return JOURNALS_PATH / f"{formula}{JOURNAL_SUFFIX}"
+
+
+def check_journal(formula):
+    if get_journal_path(formula).exists():
+        log(
+            f"{formula}: unfinished journal found, please run `recover {formula}` first.",
+            logging.ERROR,
+        )
+        raise ProgramError()
+
+
+def apply_op(op):
+    """Apply one operation, it is a no-op if the operation was already applied."""
+
+    if op["kind"] in NOOP_OPS:
+        return
+
+    count_fs_op(op["kind"])
+    path = pathlib.Path(op["path"])
+    log(f"{path.name}: doing {op['kind']}...", logging.INFO)
+
+    if op["kind"] in MOVE_OPS:
+        source = pathlib.Path(op["source"])
+        if os.path.lexists(source) or not os.path.lexists(path):
+            source.replace(path)
+    elif op["kind"] in SYMLINK_OPS:
+        if not (path.is_symlink() and os.readlink(path) == op["target"]):
+            path.symlink_to(op["target"])
+    elif op["kind"] in UNLINK_OPS:
+        path.unlink(missing_ok=True)
+    elif op["kind"] in MKDIR_OPS:
+        path.mkdir(parents=True, exist_ok=True)
+    elif op["kind"] in WRITE_OPS:
+        content = render_dotfile(pathlib.Path(op["source"]), op["mode"])
+        if not has_content(path, content):
+            write_dotfile(path, content, op["source"])
+    elif op["kind"] in REMOVE_OPS:
+        path.unlink(missing_ok=True)
+
+
+def undo_op(op):
+    """Undo one operation, it is a no-op if the operation was not applied yet."""
+
+    if op["kind"] in NOOP_OPS:
+        return
+
+    path = pathlib.Path(op["path"])
+    log(f"{path.name}: undoing {op['kind']}...", logging.INFO)
+
+    if op["kind"] in MOVE_OPS:
+        source = pathlib.Path(op["source"])
+        if os.path.lexists(path) and not os.path.lexists(source):
+            path.replace(source)
+    elif op["kind"] in SYMLINK_OPS:
+        if path.is_symlink() and os.readlink(path) == op["target"]:
+            path.unlink()
+    elif op["kind"] in UNLINK_OPS:
+        if not os.path.lexists(path):
+            path.symlink_to(op["target"])
+    elif op["kind"] == "write":
+        if path.is_file() and not path.is_symlink():
+            path.unlink()
+    elif op["kind"] in REMOVE_OPS:
+        # A `rewrite` is not undone, the copy it replaced was rendered from the counter too.
+        if not os.path.lexists(path):
+            source = pathlib.Path(op["source"])
+            write_dotfile(path, render_dotfile(source, op["mode"]), source)
+
+
+def write_journal(journal_path, header):
+    """Write the planned operations durably, before any of them is applied."""
+
+    JOURNALS_PATH.mkdir(parents=True, exist_ok=True)
+    with journal_path.open("x") as fp:
+        fp.write(json.dumps(header) + "\n")
+        fp.flush()
+        os.fsync(fp.fileno())
+    fsync_dir(JOURNALS_PATH)
+
+
+def read_journal(journal_path):
+    """Read the planned operations and the indexes of those already applied."""
+
+    with journal_path.open() as fp:
+        lines = fp.read().splitlines()
+
+    try:
+        header = json.loads(lines[0])
+    except (IndexError, json.decoder.JSONDecodeError):
+        # Nothing is applied before the header is written completely.
+        return None, set()
+
+    done = set()
+    for line in lines[1:]:
+        try:
+            done.add(json.loads(line)["done"])
+        except (json.decoder.JSONDecodeError, KeyError, TypeError):
+            # A torn write of the last line, its operation counts as not done.
+            break
+    return header, done
+
+
+def close_journal(journal_path):
+    journal_path.unlink(missing_ok=True)
+    fsync_dir(JOURNALS_PATH)
+
+
+def run_transaction(formula, action, dotfiles, ops):
+    """Apply the operations of a formula as a journaled transaction.
+
+    If one of them fails, the applied ones are rolled back. If the program dies,
+    the journal is left behind for the `recover` command.
+    """
+
+    journal_path = get_journal_path(formula)
+    header = {
+        "formula": formula,
+        "action": action,
+        "dotfiles": [
+            {key: str(value) for key, value in config.items()} for config in dotfiles
+        ],
+        "ops": ops,
+    }
+    write_journal(journal_path, header)
+
+    with journal_path.open("a") as fp:
+        for index, op in enumerate(ops):
+            started = time.perf_counter()
+            try:
+                apply_op(op)
+            except OSError as e:
+                log(f"{op['path']}: {op['kind']} error, {e}.", logging.ERROR)
+                # The failed operation was not applied, only those before it are undone.
+                for applied_op in reversed(ops[:index]):
+                    try:
+                        undo_op(applied_op)
+                    except OSError as e:
+                        log(
+                            f"{applied_op['path']}: undo {applied_op['kind']} error, {e}.",
+                            logging.ERROR,
+                        )
+                close_journal(journal_path)
+                raise ProgramError()
+
+            op["elapsed"] = time.perf_counter() - started
+
+            fp.write(json.dumps({"done": index}) + "\n")
+            fp.flush()
+            # A no-op may be lost in a crash, the sync after the next change keeps it.
+            if op["kind"] not in NOOP_OPS:
+                os.fsync(fp.fileno())
+
+    close_journal(journal_path)
+
+
+def record_dotfiles(dotfiles, ops, stale_only=False):
+    """Record the status of the dotfiles, the link targets are known from the ops.
+
+    With `stale_only` the dotfiles whose recorded status still holds are skipped.
+    """
+
+    targets = {
+        op["path"]: op["digest"] if op["kind"] in WRITE_OPS else op["target"]
+        for op in ops
+        if op["kind"] in SYMLINK_OPS | WRITE_OPS or op["kind"] == "skip-already-mounted"
+    }
+
+    # A removed copy is not ours anymore, even if the restored file is changed later.
+    forget_dotfiles([op["path"] for op in ops if op["kind"] in REMOVE_OPS])
+
+    states = {}
+    if stale_only:
+        states = load_dotfile_states([config["system"] for config in dotfiles])
+
+    statements = []
+    for config in dotfiles:
+        state = states.get(str(config["system"]))
+        if is_dotfile_state_fresh(
+            state, config["counter"], config["system"], config["backup"]
+        ):
+            continue
+
+        mode = config.get("mode", DOTFILE_MODES[0])
+        target = targets.get(str(config["system"]))
+        if target is not None and mode == "link":
+            target = pathlib.Path(target)
+        state = probe_dotfile(
+            config["counter"], config["system"], config["backup"], target, mode
+        )
+        statements.append(get_record_statement(state))
+
+    # All in one transaction, a formula walked by `**` may have thousands of dotfiles.
+    if statements:
+        update_database(*statements)
+
+
+def plan_formula(formula, formula_info, plan_dotfile):
+    """Turn the dotfiles of a formula into one plan, each directory is made once."""
+
+    dotfiles, ops, dirs = [], [], set()
+    for config in yield_dotfiles(formula, formula_info):
+        dotfiles.append(config)
+        for op in plan_dotfile(**config):
+            if op["kind"] in MKDIR_OPS:
+                if op["path"] in dirs:
+                    continue
+                dirs.add(op["path"])
+            ops.append(op)
+
+    return dotfiles, ops
+
+
+def execute_plan(formula, action, dotfiles, ops):
+    """Apply the plan in bulk, or just show it in dry run mode."""
+
+    PLANS[formula] = ops
+    if DRY_RUN:
+        show_plan(ops)
+        return False
+
+    # E.g. a re-run with everything mounted already, no journal is worth its fsyncs.
+    # The status is still recorded if it is missing, e.g. after a database rebuild.
+    if all(op["kind"] in NOOP_OPS for op in ops):
+        record_dotfiles(dotfiles, ops, stale_only=True)
+        return True
+
+    run_transaction(formula, action, dotfiles, ops)
+    record_dotfiles(dotfiles, ops)
+    return True
+
+
+def show_plan(ops):
+    for op in ops:
+        line = f"{op['kind']}:".ljust(PLAN_JUST_WIDTH) + op["path"]
+        if "source" in op:
+            line += f" <- {op['source']}"
+        if "target" in op:
+            line += f" -> {op['target']}"
+
+        if op["kind"] == "conflict":
+            log(line, logging.ERROR, True)
+        elif op["kind"] in NOOP_OPS:
+            log(line, logging.INFO, True)
+        else:
+            log(line, logging.WARNING, True)
+
+
+def dump_plans(action):
+    if PLAN_JSON is None:
+        return
+
+    document = {"action": action, "dry_run": DRY_RUN, "formulae": PLANS}
+    with open(PLAN_JSON, "w") as fp:
+        json.dump(document, fp, indent=2)
+        fp.write("\n")
+    log(f"{PLAN_JSON}: plan dumped.", logging.INFO)
+
+
+def add_plan_arguments(parser, action):
+    parser.add_argument(
+        "-n",
+        "--dry-run",
+        action="store_true",
+        help="show the planned operations without touching any file",
+    )
+    parser.add_argument(
+        "--plan-json",
+        type=str,
+        metavar="PATH",
+        help="dump the planned operations (with their cost if applied) as JSON",
+    )
+
+    def pre_processor(args):
+        global DRY_RUN
+        DRY_RUN = args.dry_run
+
+        global PLAN_JSON
+        PLAN_JSON = args.plan_json
+
+    def post_processor(args):
+        dump_plans(action)
+
+    return pre_processor, post_processor
+
+
+# ==================================================
+# Backups
+# ==================================================
+
+
+def get_manifest_path(formula, generation):
+    return BACKUP_MANIFESTS_PATH / formula / f"{generation}{BACKUP_MANIFEST_SUFFIX}"
+
+
+def list_generations(formula):
+    """List the archived generations of a formula, the oldest first."""
+
+    try:
+        names = os.listdir(BACKUP_MANIFESTS_PATH / formula)
+    except FileNotFoundError:
+        return []
+
+    stems = [name[: -len(BACKUP_MANIFEST_SUFFIX)] for name in names]
+    return sorted(int(stem) for stem in stems if stem.isdigit())
+
+
+def load_manifest(formula, generation):
+    with get_manifest_path(formula, generation).open() as fp:
+        return json.load(fp)
+
+
+def get_object_path(digest):
+    return BACKUP_OBJECTS_PATH / digest[:2] / digest
+
+
+def store_object(path):
+    """Copy a file into the object store, once for each distinct content."""
+
+    digest = hash_file(path)
+    object_path = get_object_path(digest)
+    if not object_path.exists():
+        object_path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = object_path.with_name(f"{digest}.{threading.get_ident()}.tmp")
+        shutil.copyfile(path, temp_path)
+        temp_path.replace(object_path)
+    return digest
+
+
+def scan_backups(dir_path, prefix=""):
+    """Walk the backups lazily, the nested ones are named by their relative paths."""
+
+    with os.scandir(dir_path) as entries:
+        entries = sorted(entries, key=lambda entry: entry.name)
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            yield from scan_backups(entry.path, f"{prefix}{entry.name}/")
+        else:
+            yield f"{prefix}{entry.name}", entry
+
+
+def clear_backups(backup_dir_path):
+    for backup_path in backup_dir_path.iterdir():
+        if backup_path.is_dir() and not backup_path.is_symlink():
+            shutil.rmtree(backup_path)
+        else:
+            backup_path.unlink()
+
+
+def archive_backups(formula, evict=True):
+    """Archive the backups of a formula as a new generation, if they changed."""
+
+    backup_dir_path = BACKUPS_PATH / formula
+    files = {}
+    try:
+        with BACKUPS_LOCK:
+            for name, entry in scan_backups(backup_dir_path):
+                if entry.is_symlink():
+                    files[name] = {"target": os.readlink(entry.path)}
+                elif entry.is_file():
+                    files[name] = {
+                        "object": store_object(entry.path),
+                        "mode": stat.S_IMODE(entry.stat().st_mode),
+                    }
+
+            generations = list_generations(formula)
+            if not files or (
+                generations
+                and load_manifest(formula, generations[-1])["files"] == files
+            ):
+                return
+
+            generation = generations[-1] + 1 if generations else 1
+            manifest_path = get_manifest_path(formula, generation)
+            manifest_path.parent.mkdir(parents=True, exist_ok=True)
+            temp_path = manifest_path.with_name(f"{manifest_path.name}.tmp")
+            with temp_path.open("w") as fp:
+                manifest = {
+                    "formula": formula,
+                    "generation": generation,
+                    "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                    "files": files,
+                }
+                json.dump(manifest, fp, indent=2)
+                fp.write("\n")
+            temp_path.replace(manifest_path)
+            log(
+                f"{formula}: backups archived as generation {generation}.", logging.INFO
+            )
+
+            if evict:
+                evict_generations(formula)
+    except (OSError, ValueError, KeyError) as e:
+        log(f"{backup_dir_path}: archive error, {e}.", logging.ERROR)
+        raise ProgramError()
+
+
+def load_backup_generations():
+    """How many generations to keep, as saved by the last `--keep-generations`."""
+
+    try:
+        with BACKUP_SETTINGS_PATH.open() as fp:
+            generations = json.load(fp)["keep_generations"]
+    except (OSError, ValueError, KeyError, TypeError):
+        return BACKUP_GENERATIONS
+    if not isinstance(generations, int) or generations < 1:
+        return BACKUP_GENERATIONS
+    return generations
+
+
+def save_backup_generations(generations):
+    """Save the number of generations to keep, so `cancel` and `serve` keep it too."""
+
+    BACKUP_SETTINGS_PATH.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = BACKUP_SETTINGS_PATH.with_name(f"{BACKUP_SETTINGS_PATH.name}.tmp")
+    with temp_path.open("w") as fp:
+        json.dump({"keep_generations": generations}, fp, indent=2)
+        fp.write("\n")
+    temp_path.replace(BACKUP_SETTINGS_PATH)
+
+
+def evict_generations(formula):
+    """Keep the newest generations of a formula, and drop the objects left unused."""
+
+    keep = load_backup_generations()
+    generations = list_generations(formula)
+    if len(generations) <= keep:
+        return
+
+    with BACKUPS_LOCK:
+        for generation in generations[: len(generations) - keep]:
+            get_manifest_path(formula, generation).unlink()
+            log(f"{formula}: generation {generation} evicted.", logging.INFO)
+
+        referenced = set()
+        for manifest_path in BACKUP_MANIFESTS_PATH.glob(f"*/*{BACKUP_MANIFEST_SUFFIX}"):
+            with manifest_path.open() as fp:
+                files = json.load(fp)["files"]
+            referenced.update(
+                item["object"] for item in files.values() if "object" in item
+            )
+
+        for object_path in BACKUP_OBJECTS_PATH.glob("*/*"):
+            if object_path.name not in referenced and object_path.suffix != ".tmp":
+                object_path.unlink()
+
+
+def restore_generation(formula, generation):
+    """Put a generation back to the backups of a formula, for `cancel` to restore."""
+
+    generations = list_generations(formula)
+    if generation not in generations:
+        log(
+            f"{formula}: generation {generation} not found, those are kept: {generations}.",
+            logging.ERROR,
+        )
+        raise ProgramError()
+
+    backup_dir_path = BACKUPS_PATH / formula
+    backup_dir_path.mkdir(parents=True, exist_ok=True)
+    with BACKUPS_LOCK:
+        manifest = load_manifest(formula, generation)
+        # The current backups are archived, but nothing is evicted until it is done.
+        archive_backups(formula, evict=False)
+        clear_backups(backup_dir_path)
+
+        for name, item in manifest["files"].items():
+            backup_path = backup_dir_path / name
+            backup_path.parent.mkdir(parents=True, exist_ok=True)
+            if "target" in item:
+                backup_path.symlink_to(item["target"])
+            else:
+                shutil.copyfile(get_object_path(item["object"]), backup_path)
+                backup_path.chmod(item["mode"])
+        # Nothing is evicted by a restore, the next `order` does it.
+        log(f"{formula}: generation {generation} put back to backups.", logging.INFO)
+
+
+# ==================================================
+# Stats
+# ==================================================
+
+
+def new_stats_bucket():
+    return {"phases": {}, "ops": {}}
+
+
+def get_stats_buckets():
+    """The total, the current formula and the current dotfile, all to be counted."""
+
+    buckets = [STATS]
+    if (formula := getattr(STATS_CONTEXT, "formula", None)) is not None:
+        buckets.append(STATS["formulae"].setdefault(formula, new_stats_bucket()))
+        if (dotfile := getattr(STATS_CONTEXT, "dotfile", None)) is not None:
+            key = f"{formula}/{dotfile}"
+            buckets.append(STATS["dotfiles"].setdefault(key, new_stats_bucket()))
+    return buckets
+
+
+def count_op(name):
+    with STATS_LOCK:
+        for bucket in get_stats_buckets():
+            bucket["ops"][name] = bucket["ops"].get(name, 0) + 1
+
+
+@contextlib.contextmanager
+def measure(phase, formula=None, dotfile=None):
+    """Time a phase, without the time of the phases nested in it."""
+
+    saved = (
+        getattr(STATS_CONTEXT, "formula", None),
+        getattr(STATS_CONTEXT, "dotfile", None),
+    )
+    if formula is not None:
+        STATS_CONTEXT.formula, STATS_CONTEXT.dotfile = formula, None
+    if dotfile is not None:
+        STATS_CONTEXT.dotfile = dotfile
+
+    children = getattr(STATS_CONTEXT, "children", None)
+    STATS_CONTEXT.children = [0.0]
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        own = elapsed - STATS_CONTEXT.children[0]
+        with STATS_LOCK:
+            for bucket in get_stats_buckets():
+                timer = bucket["phases"].setdefault(phase, {"calls": 0, "seconds": 0.0})
+                timer["calls"] += 1
+                timer["seconds"] += own
+
+        STATS_CONTEXT.children = children
+        if children is not None:
+            children[0] += elapsed
+        STATS_CONTEXT.formula, STATS_CONTEXT.dotfile = saved
+
+
+def instrument(phase, level):
+    """Replace a global function by a timed one, nothing is wrapped unless enabled."""
+
+    import inspect
+
+    function = globals()[phase]
+
+    def get_key(args, kwargs):
+        argument = args[0] if args else next(iter(kwargs.values()))
+        if level == "formula":
+            return {"formula": argument}
+        if isinstance(argument, dict):
+            return {"dotfile": pathlib.Path(argument["path"]).name}
+
+        key = {"dotfile": argument.name}
+        # E.g. `status_dotfile` is called out of any timed phase of its formula.
+        if getattr(STATS_CONTEXT, "formula", None) is None:
+            with contextlib.suppress(ValueError, IndexError):
+                key["formula"] = argument.relative_to(COUNTER_PATH).parts[0]
+        return key
+
+    if inspect.isgeneratorfunction(function):
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            iterator = function(*args, **kwargs)
+            while True:
+                with measure(phase, **get_key(args, kwargs)):
+                    item = next(iterator, StopIteration)
+                if item is StopIteration:
+                    return
+                yield item
+
+    else:
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with measure(phase, **get_key(args, kwargs)):
+                return function(*args, **kwargs)
+
+    globals()[phase] = wrapper
+
+
+def count_fs_op(name):
+    """Count a filesystem operation of this module, nothing is counted unless enabled."""
+
+    if STATS is not None:
+        count_op(name)
+
+
+def enable_stats(stats_format):
+    global STATS, STATS_FORMAT, STATS_STARTED
+    STATS = {**new_stats_bucket(), "formulae": {}, "dotfiles": {}}
+    STATS_FORMAT = stats_format
+    STATS_STARTED = time.perf_counter()
+
+    for phase, level in STATS_PHASES.items():
+        instrument(phase, level)
+
+
+def report_stats():
+    elapsed = time.perf_counter() - STATS_STARTED
+    stats = {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "argv": sys.argv[1:],
+        "elapsed": elapsed,
+        **STATS,
+    }
+
+    try:
+        LOGS_PATH.mkdir(parents=True, exist_ok=True)
+        with (LOGS_PATH / METRICS_FILENAME).open("a") as fp:
+            # The dotfiles are left out of the trend, they are too many.
+            metrics = {key: value for key, value in stats.items() if key != "dotfiles"}
+            fp.write(json.dumps(metrics) + "\n")
+    except OSError as e:
+        log(f"{METRICS_FILENAME}: write error, {e}.", logging.WARNING)
+
+    if STATS_FORMAT == "json":
+        print(json.dumps(stats, indent=2), file=sys.stderr)
+        return
+
+    lines = ["stats:", "phase:".ljust(STATS_JUST_WIDTH) + f"{'calls':>8}{'ms':>12}"]
+    for phase, timer in STATS["phases"].items():
+        lines.append(
+            phase.ljust(STATS_JUST_WIDTH)
+            + f"{timer['calls']:8}{timer['seconds'] * 1000:12.2f}"
+        )
+
+    lines.append("formula:".ljust(STATS_JUST_WIDTH) + f"{'fs ops':>8}{'ms':>12}")
+    for formula, bucket in STATS["formulae"].items():
+        ops = sum(bucket["ops"].values())
+        seconds = sum(timer["seconds"] for timer in bucket["phases"].values())
+        lines.append(formula.ljust(STATS_JUST_WIDTH) + f"{ops:8}{seconds * 1000:12.2f}")
+
+    ops = ", ".join(f"{name} {count}" for name, count in sorted(STATS["ops"].items()))
+    lines.append("fs ops:".ljust(STATS_JUST_WIDTH) + (ops or "none"))
+    lines.append("total:".ljust(STATS_JUST_WIDTH) + f"{elapsed * 1000:20.2f}")
+    print("\n".join(lines), file=sys.stderr)
+
+
+# ==================================================
+# Brew Command
+# ==================================================
+
+
+def prepare_formula(formula):
+    """Get the brew command of the formula, or `None` if it should be skipped."""
+
+    log(f"{FORMULA_FLAG} {formula}")
+
+    formula_info = get_formula_info(formula)
+
+    if formula_info.get("disabled", False):
+        log(f"disabled:".ljust(LEFT_JUST_WIDTH) + "True", logging.ERROR, True)
+        log(f"this formula `{formula}` is disabled.", logging.WARNING)
+        print("")
+        return None
+
+    cmd = ["brew", BREW_COMMAND, formula_info.get("bottle", formula)]
+
+    question_flag = "force_manage"
+    log(f"question: `{' '.join(cmd)}`, do you want to execute it?", logging.WARNING)
+    if ANSWERS[question_flag] is None:
+        answer = request_confirm(question_flag)
+    else:
+        answer = ANSWERS[question_flag]
+    log(f"answer: {'yes' if answer else 'no'}.", logging.WARNING)
+
+    print("")
+    return cmd if answer else None
+
+
+async def run_brew_task(task, semaphore, live, progress):
+    """Run one brew task, streaming its output line by line."""
+
+    verb, status = task.get("verb", "manage"), "done"
+    lines, captured = [], []
+
+    def show(line):
+        if SIMPLIFY:
+            return
+        if live:
+            print(line, end="", flush=True)
+        else:
+            lines.append(line)
+
+    async def consume(process):
+        overrun = False
+        while True:
+            try:
+                line = await process.stdout.readline()
+            except ValueError:
+                # The reader drops a part of the long line, the rest is still drained.
+                overrun = True
+                show(f"a line longer than {BREW_LINE_LIMIT} bytes is cut.\n")
+                continue
+            if not line:
+                break
+            line = line.decode(errors="replace")
+            if task.get("cache"):
+                captured.append(line)
+            show(line)
+        returncode = await process.wait()
+        return None if overrun else returncode
+
+    async with semaphore:
+        start = time.perf_counter()
+
+        if task.get("cache") and (output := load_brew_result(task["cmd"])) is not None:
+            log(f"`{' '.join(task['cmd'])}`, use the cached result.", logging.INFO)
+            show(output)
+            returncode, status = 0, "done (cached)"
+        else:
+            log(f"`{' '.join(task['cmd'])}`, execute it now.", logging.INFO)
+            returncode = await execute_brew_task(task, consume, lines)
+            if task.get("cache") and returncode == 0:
+                dump_brew_results([(task["cmd"], "".join(captured))])
+            elif not task.get("cache") and task["cmd"][1] not in BREW_PARALLEL_COMMANDS:
+                forget_brew_results(task["cmd"][2:])
+
+        task["elapsed"] = time.perf_counter() - start
+
+    progress["done"] += 1
+    counter = f"[{progress['done']}/{progress['total']}]"
+    if returncode == 0:
+        log(f"{counter} {task['label']}: {verb} {status}.", logging.INFO)
+    else:
+        log(f"{counter} {task['label']}: {verb} error.", logging.ERROR)
+    if lines:
+        print("".join(lines), end="")
+    print("")
+
+    if task.get("record") and OUTPUT_FORMAT != "table":
+        result = "done" if returncode == 0 else "error"
+        emit_record({"formula": task["label"], "result": result})
+
+    return returncode == 0
+
+
+async def execute_brew_task(task, consume, lines):
+    """Start the brew process of the task, `None` is returned if it did not finish."""
+
+    import asyncio
+
+    try:
+        process = await asyncio.create_subprocess_exec(
+            *task["cmd"],
+            env=get_brew_env(),
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT,
+            limit=BREW_LINE_LIMIT,
+        )
+    except OSError as e:
+        lines.append(f"{e}\n")
+        return None
+
+    try:
+        return await asyncio.wait_for(
+            consume(process), timeout=task.get("timeout", BREW_TIMEOUT)
+        )
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+        lines.append(f"timed out after {task.get('timeout', BREW_TIMEOUT)}s\n")
+        return None
+
+
+async def gather_brew_tasks(tasks, jobs):
+    import asyncio
+
+    semaphore = asyncio.Semaphore(jobs)
+    progress = {"done": 0, "total": len(tasks)}
+    return await asyncio.gather(
+        *[run_brew_task(task, semaphore, jobs == 1, progress) for task in tasks]
+    )
+
+
+def run_brew_tasks(tasks, jobs=1, command=None):
+    """Run the brew tasks, up to `jobs` of them at the same time.
+
+    Each task is a dict with a `label`, the `cmd` to execute, an optional `timeout`,
+    an optional `verb` for the progress lines, an optional `cache` flag to reuse
+    the results of read-only commands and an optional `record` flag to emit its
+    result as soon as it finishes; its run time is left in `elapsed`.
+    Only the read-only brew commands may run in parallel, the others hold brew's lock.
+    """
+
+    import asyncio
+
+    command = command or BREW_COMMAND
+    if jobs > 1 and command not in BREW_PARALLEL_COMMANDS:
+        log(f"`brew {command}` can not run in parallel.", logging.WARNING)
+        jobs = 1
+
+    results = asyncio.run(gather_brew_tasks(tasks, jobs))
+    return {task["label"]: result for task, result in zip(tasks, results)}
+
+
+def manage_formulae(formulae):
+    """Manage the formulae via brew, one brew invocation for each of them."""
+
+    if BREW_BATCH:
+        return manage_formulae_in_batch(formulae)
+
+    tasks, results = [], {}
+    for formula in formulae:
+        if (cmd := prepare_formula(formula)) is None:
+            results[formula] = "skipped"
+        else:
+            cache = BREW_COMMAND in BREW_CACHED_COMMANDS
+            tasks.append({"label": formula, "cmd": cmd, "cache": cache, "record": True})
+
+    if BREW_PREFETCH and tasks:
+        prefetch_bottles({task["label"]: task["cmd"][-1] for task in tasks})
+
+    # Plain `brew info` is shown as brew writes it, records need the fields of `--batch`.
+    if BREW_COMMAND == "info" and OUTPUT_FORMAT != "table":
+        bottles = {task["label"]: task["cmd"][-1] for task in tasks}
+        results.update(query_formulae_info(bottles, BREW_JOBS))
+        if len(formulae) > 1 or OUTPUT_FORMAT != "table":
+            report_formulae(
+                {formula: results[formula] for formula in formulae},
+                emitted={formula for formula in bottles if results[formula] == "done"},
+            )
+        return
+
+    for formula, done in run_brew_tasks(tasks, BREW_JOBS).items():
+        results[formula] = "done" if done else "error"
+
+    if len(formulae) > 1 or OUTPUT_FORMAT != "table":
+        report_formulae(
+            {formula: results[formula] for formula in formulae},
+            emitted={task["label"] for task in tasks},
+        )
+
+
+def manage_formulae_in_batch(formulae):
+    """Manage the formulae in batch, only a few brew invocations for all of them."""
+
+    log(f"{FORMULA_FLAG} {' '.join(formulae)}")
+
+    bottles, results = {}, {}
+    for formula in formulae:
+        formula_info = get_formula_info(formula)
+        if formula_info.get("disabled", False):
+            results[formula] = "disabled"
+        else:
+            bottles[formula] = formula_info.get("bottle", formula)
+
+    if bottles:
+        cmd = ["brew", BREW_COMMAND, *bottles.values()]
+
+        question_flag = "force_manage"
+        log(f"question: `{' '.join(cmd)}`, do you want to execute it?", logging.WARNING)
+        if ANSWERS[question_flag] is None:
+            answer = request_confirm(question_flag)
+        else:
+            answer = ANSWERS[question_flag]
+        log(f"answer: {'yes' if answer else 'no'}.", logging.WARNING)
+
+        if not answer:
+            print("")
+            return
+    print("")
+
+    if BREW_PREFETCH and bottles:
+        prefetch_bottles(bottles)
+
+    if BREW_COMMAND == "info":
+        results.update(query_formulae_info(bottles))
+        # The bottles brew knows are written with their info already.
+        report_formulae(
+            {formula: results[formula] for formula in formulae},
+            emitted={formula for formula in bottles if results[formula] == "done"},
+        )
+        return
+
+    items = list(bottles.items())
+    chunks = {}
+    for index in range(0, len(items), BREW_BATCH_SIZE):
+        chunk = dict(items[index : index + BREW_BATCH_SIZE])
+        chunks[" ".join(chunk)] = chunk
+
+    tasks = [
+        {
+            "label": label,
+            "cmd": ["brew", BREW_COMMAND, *chunk.values()],
+            "timeout": min(BREW_TIMEOUT * len(chunk), BREW_BATCH_TIMEOUT),
+        }
+        for label, chunk in chunks.items()
+    ]
+
+    retries = []
+    for label, done in run_brew_tasks(tasks, BREW_JOBS).items():
+        if done or len(chunks[label]) == 1:
+            results.update(dict.fromkeys(chunks[label], "done" if done else "error"))
+        else:
+            retries.extend(chunks[label].items())
+
+    # One broken bottle fails the whole invocation, so find out which one it was.
+    if retries:
+        log("batch failed, retry the formulae one by one.", logging.WARNING)
+        tasks = [
+            {"label": formula, "cmd": ["brew", BREW_COMMAND, bottle]}
+            for formula, bottle in retries
+        ]
+        for formula, done in run_brew_tasks(tasks, BREW_JOBS).items():
+            results[formula] = "done" if done else "error"
+
+    report_formulae({formula: results[formula] for formula in formulae})
+
+
+def query_formulae_info(bottles, jobs=None):
+    """Ask brew about all the bottles in one JSON call, then show them one by one.
+
+    With `jobs` each bottle is asked about in its own call, up to `jobs` at a time.
+    """
+
+    import concurrent.futures
+
+    infos = {}
+    for formula, bottle in bottles.items():
+        if (
+            output := load_brew_result(["brew", "info", "--json=v2", bottle])
+        ) is not None:
+            infos[formula] = json.loads(output)
+    log(f"{len(infos)} of {len(bottles)} bottles are cached.", logging.INFO)
+
+    missing = {
+        formula: bottle for formula, bottle in bottles.items() if formula not in infos
+    }
+    if missing and jobs is not None:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            for fetched in executor.map(
+                lambda item: fetch_formulae_info(dict([item])), missing.items()
+            ):
+                infos.update(fetched)
+    elif missing:
+        infos.update(fetch_formulae_info(missing))
+
+    # One unknown bottle fails the whole call, so find out which one it was.
+    if (
+        jobs is None
+        and len(missing) > 1
+        and not any(formula in infos for formula in missing)
+    ):
+        log("batch failed, query the formulae one by one.", logging.WARNING)
+        for formula, bottle in missing.items():
+            infos.update(fetch_formulae_info({formula: bottle}))
+    print("")
+
+    results = {}
+    for formula in bottles:
+        log(f"{FORMULA_FLAG} {formula}")
+        if (info := infos.get(formula)) is None:
+            log(f"this bottle `{bottles[formula]}` is unknown to brew.", logging.ERROR)
+            results[formula] = "error"
+        else:
+            if OUTPUT_FORMAT != "table":
+                fields = get_bottle_fields(info)
+                emit_record({"formula": formula, "result": "done", "info": fields})
+            elif not SIMPLIFY:
+                show_bottle_info(info)
+            results[formula] = "done"
+        print("")
+
+    return results
+
+
+def fetch_formulae_info(bottles):
+    """Run `brew info --json=v2` for the bottles, and cache the info of each one."""
+
+    import subprocess
+
+    cmd = ["brew", "info", "--json=v2", *bottles.values()]
+    log(f"`{' '.join(cmd)}`, execute it now.", logging.INFO)
+    try:
+        process = subprocess.run(
+            cmd,
+            env=get_brew_env(),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+            timeout=BREW_TIMEOUT,
+        )
+        data = json.loads(process.stdout) if process.returncode == 0 else {}
+    except (OSError, subprocess.TimeoutExpired, json.decoder.JSONDecodeError) as e:
+        log(f"`{' '.join(cmd)}`, query error, {e}.", logging.ERROR)
+        return {}
+
+    # A bottle may be named by its full name or one of its aliases.
+    names = {}
+    for info in data.get("formulae", []):
+        for name in [info["name"], info.get("full_name"), *info.get("aliases", [])]:
+            names[name] = info
+    for info in data.get("casks", []):
+        for name in [info["token"], info.get("full_token")]:
+            names[name] = info
+
+    infos = {
+        formula: names[bottle] for formula, bottle in bottles.items() if bottle in names
+    }
+    dump_brew_results(
+        [
+            (["brew", "info", "--json=v2", bottles[formula]], json.dumps(info))
+            for formula, info in infos.items()
+        ]
+    )
+    return infos
+
+
+def get_bottle_fields(info):
+    """Pick the main fields of the `brew info --json=v2` result of a bottle."""
+
+    if "token" in info:
+        fields = {
+            "name": info["token"],
+            "version": info.get("version"),
+            "description": info.get("desc"),
+            "website": info.get("homepage"),
+            "installed": info.get("installed"),
+        }
+    else:
+        fields = {
+            "name": info.get("full_name", info["name"]),
+            "version": info.get("versions", {}).get("stable"),
+            "description": info.get("desc"),
+            "website": info.get("homepage"),
+            "installed": ", ".join(i["version"] for i in info.get("installed", [])),
+        }
+    fields["outdated"] = bool(info.get("outdated"))
+    return fields
+
+
+def show_bottle_info(info):
+    for field, value in get_bottle_fields(info).items():
+        if isinstance(value, bool):
+            value = "yes" if value else "no"
+        print(f"{field}:".ljust(LEFT_JUST_WIDTH) + (value or "no"))
+
+
+def prefetch_bottles(bottles):
+    """Download the bottles concurrently, so the installs after only hit the cache."""
+
+    import subprocess
+
+    log(
+        f"prefetch {len(bottles)} bottles, {BREW_PREFETCH_JOBS} at a time.",
+        logging.INFO,
+    )
+    print("")
+
+    tasks = [
+        {"label": formula, "cmd": ["brew", "fetch", bottle], "verb": "fetch"}
+        for formula, bottle in bottles.items()
+    ]
+    results = run_brew_tasks(tasks, BREW_PREFETCH_JOBS, "fetch")
+
+    # `brew --cache` takes many formulae at once and prints one path for each.
+    process = subprocess.run(
+        ["brew", "--cache", *bottles.values()],
+        env=get_brew_env(),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        text=True,
+    )
+    paths = process.stdout.splitlines() if process.returncode == 0 else []
+    if len(paths) != len(bottles):
+        paths = [None] * len(bottles)
+
+    mirror = "tuna" if USE_TUNA_MIRROR else "default"
+    width = max([LEFT_JUST_WIDTH, *[len(formula) + 2 for formula in bottles]])
+    log(f"prefetch report, {mirror} mirror:", logging.INFO)
+    for task, path in zip(tasks, paths):
+        formula = task["label"]
+        try:
+            size = f"{os.path.getsize(path) / 1024 / 1024:10.2f} MiB"
+        except (OSError, TypeError):
+            size = "unknown".rjust(14)
+        line = f"{formula}:".ljust(width) + f"{task['elapsed']:8.2f}s {size}"
+        if results[formula]:
+            log(line, logging.INFO, True)
+        else:
+            log(line + "  error", logging.ERROR, True)
+    print("")
+
+
+def report_formulae(results, emitted=()):
+    """Show the result of every managed formula, as records unless in a table."""
+
+    if OUTPUT_FORMAT != "table":
+        for formula, result in results.items():
+            if formula not in emitted:
+                emit_record({"formula": formula, "result": result})
+        return
+
+    levels = {
+        "done": logging.INFO,
+        "skipped": logging.WARNING,
+        "disabled": logging.WARNING,
+        "error": logging.ERROR,
+    }
+
+    width = max([LEFT_JUST_WIDTH, *[len(formula) + 2 for formula in results]])
+    for formula, result in results.items():
+        log(f"{formula}:".ljust(width) + result, levels[result], True)
+
+    print("")
+
+
+def add_manage_parser(subparsers):
+    """Create the parser for the `brew` command."""
+
+    parser = add_sub_parser(subparsers, "brew")
+
+    parser.add_argument(
+        "command",
+        type=str,
+        metavar="COMMAND",
+        help="command supported by brew",
+    )
+    parser.add_argument(
+        "-s",
+        "--simplify",
+        action="store_true",
+        help="simplifies the output",
+    )
+    parser.add_argument(
+        "-f",
+        "--force",
+        action="store_true",
+        help="manage formulae without asking for confirm",
+    )
+    parser.add_argument(
+        "--use-tuna-mirror",
+        action="store_true",
+        help="use TUNA mirror for brew commonds",
+    )
+    parser.add_argument(
+        "--auto-update",
+        action="store_true",
+        help="run on auto-updates (e.g. before brew install) to skips some slower steps",
+    )
+    parser.add_argument(
+        "-b",
+        "--batch",
+        action="store_true",
+        help="manage all formulae with as few brew invocations as possible",
+    )
+    parser.add_argument(
+        "--prefetch",
+        action="store_true",
+        help="download all bottles concurrently before installing them",
+    )
+    parser.add_argument(
+        "--prefetch-jobs",
+        type=positive_int,
+        default=BREW_PREFETCH_JOBS,
+        metavar="N",
+        help=f"download up to N bottles at the same time (default: {BREW_PREFETCH_JOBS})",
+    )
+    parser.add_argument(
+        "--refresh",
+        action="store_true",
+        help="query brew again instead of using the cached results of read-only commands",
+    )
+
+    format_pre_processor = add_format_arguments(parser)
+
+    def pre_processor(args):
+        format_pre_processor(args)
+
+        global BREW_COMMAND
+        BREW_COMMAND = args.command
+
+        global SIMPLIFY
+        SIMPLIFY = args.simplify
+
+        if args.force:
+            ANSWERS["force_manage"] = True
+
+        global BREW_BATCH
+        BREW_BATCH = args.batch
+
+        global BREW_JOBS
+        BREW_JOBS = args.jobs
+
+        global BREW_PREFETCH, BREW_PREFETCH_JOBS
+        BREW_PREFETCH = args.prefetch and BREW_COMMAND in BREW_PREFETCH_COMMANDS
+        BREW_PREFETCH_JOBS = args.prefetch_jobs
+        if args.prefetch and not BREW_PREFETCH:
+            log(
+                f"`brew {BREW_COMMAND}` downloads nothing, no prefetch.",
+                logging.WARNING,
+            )
+
+        global BREW_REFRESH
+        BREW_REFRESH = args.refresh
+
+        global USE_TUNA_MIRROR
+        USE_TUNA_MIRROR = args.use_tuna_mirror
+
+        if args.auto_update:
+            import subprocess
+
+            cmd = ["brew", "update", "--auto-update"]
+            log(f"`{' '.join(cmd)}`, execute it now.", logging.INFO)
+            subprocess.run(cmd, env=get_brew_env())
+            forget_brew_results()
+
+    parser = build_common_cmd(
+        parser,
+        manage_formulae,
+        pre_processor=pre_processor,
+        concurrent=True,
+        bulk=True,
+        ordered=True,
+    )
+    return parser
+
+
+# ==================================================
+# Menu Command
+# ==================================================
+
+
+def list_formula(formula):
+    log(f"{FORMULA_FLAG} {formula}")
+
+    formula_info = get_formula_info(formula)
+
+    if OUTPUT_FORMAT != "table":
+        record = {"formula": formula, "disabled": formula_info.get("disabled", False)}
+        for info in ["name", "version", "description", "website"]:
+            record[info] = formula_info.get(info)
+        emit_record(record)
+        return
+
+    if formula_info.get("disabled", False):
+        log(f"disabled:".ljust(LEFT_JUST_WIDTH) + "True", logging.ERROR, True)
+
+    for info in ["name", "version", "description", "website"]:
+        print(f"{info}:".ljust(LEFT_JUST_WIDTH) + formula_info.get(info, "Not found."))
+
+    print("")
+
+
+def add_list_parser(subparsers):
+    """Create the parser for the `menu` command."""
+
+    parser = add_sub_parser(subparsers, "menu")
+
+    parser.add_argument(
+        "-s",
+        "--simplify",
+        action="store_true",
+        help="simplifies the output",
+    )
+
+    format_pre_processor = add_format_arguments(parser)
+
+    def pre_processor(args):
+        if args.simplify:
+            formulae = get_target_formulae(args)
+            print(" ".join(formulae))
+            exit(0)
+
+        format_pre_processor(args)
+
+    parser = build_common_cmd(parser, list_formula, pre_processor=pre_processor)
+    return parser
+
+
+# ==================================================
+# Order Command
+# ==================================================
+
+
+def plan_mount_dotfile(counter, system, backup=None, mode="link"):
+    """Decide the operations to mount a dotfile, without touching anything."""
+
+    if mode != "link":
+        return plan_copy_dotfile(counter, system, backup, mode)
+
+    if (target := resolve_path(system)) == counter:
+        return [
+            {
+                "kind": "skip-already-mounted",
+                "path": str(system),
+                "target": str(counter),
+            }
+        ]
+
+    if system.is_symlink():
+        target = str(target)
+        ops = [
+            *plan_backup_dir(backup),
+            {"kind": "backup-symlink", "path": str(backup), "target": target},
+            {"kind": "backup-unlink", "path": str(system), "target": target},
+        ]
+    elif system.is_file() or system.is_dir() and counter.is_dir():
+        # A directory mounted as a whole moves the existing one aside as a whole.
+        ops = [
+            *plan_backup_dir(backup),
+            {"kind": "backup-move", "path": str(backup), "source": str(system)},
+        ]
+    elif system.exists():
+        log(f"{system.name}: unknown existed backup dotfile.", logging.ERROR)
+        return [{"kind": "conflict", "path": str(system)}]
+    else:
+        log(f"{system}: system file not exists.", logging.WARNING)
+        ops = [{"kind": "mkdir", "path": str(system.parent)}]
+
+    ops.append({"kind": "symlink", "path": str(system), "target": str(counter)})
+    return ops
+
+
+def plan_backup_dir(backup):
+    """Make the directory of a nested backup, the backups of a formula exist already."""
+
+    if backup.parent.is_dir():
+        return []
+    return [{"kind": "mkdir", "path": str(backup.parent)}]
+
+
+def plan_copy_dotfile(counter, system, backup, mode):
+    """Decide the operations to copy or render a dotfile, it is written only if changed."""
+
+    try:
+        digest = hash_content(render_dotfile(counter, mode))
+    except KeyError as e:
+        log(
+            f"{counter.name}: ${e.args[0]} unknown environment variable.", logging.ERROR
+        )
+        return [{"kind": "conflict", "path": str(system)}]
+    except (OSError, UnicodeDecodeError) as e:
+        log(f"{counter.name}: render error, {e}.", logging.ERROR)
+        return [{"kind": "conflict", "path": str(system)}]
+
+    # The recorded status saves reading the system file, if it did not change since.
+    state = get_dotfile_state(counter, system, backup, mode=mode)
+    write = {
+        "kind": "write",
+        "path": str(system),
+        "source": str(counter),
+        "mode": mode,
+        "digest": digest,
+    }
+
+    if state["system_status"] == "mounted" and state["target"] == digest:
+        return [{"kind": "skip-already-mounted", "path": str(system), "target": digest}]
+
+    if system.is_symlink():
+        # E.g. it was mounted as a link before, then the link is just replaced.
+        target = str(resolve_path(system))
+        if target == str(counter):
+            ops = [{"kind": "unlink", "path": str(system), "target": target}]
+        else:
+            ops = [
+                *plan_backup_dir(backup),
+                {"kind": "backup-symlink", "path": str(backup), "target": target},
+                {"kind": "backup-unlink", "path": str(system), "target": target},
+            ]
+    elif state["system_status"] == "mounted":
+        ops = []
+        write["kind"] = "rewrite"
+    elif system.is_file():
+        # E.g. a copy changed in place since it was written, it is backed up first.
+        ops = [
+            *plan_backup_dir(backup),
+            {"kind": "backup-move", "path": str(backup), "source": str(system)},
+        ]
+    elif system.exists():
+        log(f"{system.name}: unknown existed backup dotfile.", logging.ERROR)
+        return [{"kind": "conflict", "path": str(system)}]
+    else:
+        log(f"{system}: system file not exists.", logging.WARNING)
+        ops = [{"kind": "mkdir", "path": str(system.parent)}]
+
+    ops.append(write)
+    return ops
+
+
+def mount_dotfile(counter, system, backup=None, mode="link"):
+    ops = plan_mount_dotfile(counter, system, backup, mode)
+    for op in ops:
+        apply_op(op)
+
+    config = {"counter": counter, "system": system, "backup": backup, "mode": mode}
+    record_dotfiles([config], ops)
+    return any(op["kind"] not in NOOP_OPS for op in ops)
+
+
+def mount_formula(formula):
+    log(f"{FORMULA_FLAG} {formula}")
+
+    formula_info = get_formula_info(formula)
+
+    if formula_info.get("disabled", False):
+        log(f"disabled:".ljust(LEFT_JUST_WIDTH) + "True", logging.ERROR, True)
+        log(f"this formula `{formula}` is disabled.", logging.WARNING)
+        print("")
+        return
+
+    check_journal(formula)
+
+    # Only `--incremental` needs the fingerprint, it walks the whole counter tree.
+    fingerprint = fingerprint_formula(formula, formula_info) if INCREMENTAL else None
+    if INCREMENTAL and is_formula_up_to_date(formula, fingerprint):
+        log(f"{formula}: up-to-date.", logging.INFO)
+        print("")
+        return
+
+    log(f"{formula}: mount start...", logging.INFO)
+
+    if not DRY_RUN:
+        init_backups(formula)
+    dotfiles, ops = plan_formula(formula, formula_info, plan_mount_dotfile)
+    if execute_plan(formula, "order", dotfiles, ops):
+        archive_backups(formula)
+        if fingerprint is None:
+            # A fingerprint left by an older run no longer tells what is mounted.
+            forget_formula(formula)
+        else:
+            systems = [config["system"] for config in dotfiles]
+            record_formula(formula, fingerprint, systems)
+
+    log(f"{formula}: mount {'planned' if DRY_RUN else 'done'}.", logging.INFO)
+    print("")
+
+
+def add_mount_parser(subparsers):
+    """Create the parser for the `order` command."""
+
+    parser = add_sub_parser(subparsers, "order")
+
+    parser.add_argument(
+        "-i",
+        "--incremental",
+        action="store_true",
+        help="skip the formulae those are still mounted since the last run",
+    )
+    parser.add_argument(
+        "--keep-generations",
+        type=positive_int,
+        metavar="N",
+        help="keep the newest N generations of backups, from now on "
+        f"(default: {BACKUP_GENERATIONS})",
+    )
+
+    plan_pre_processor, post_processor = add_plan_arguments(parser, "order")
+
+    def pre_processor(args):
+        global INCREMENTAL
+        INCREMENTAL = args.incremental
+
+        plan_pre_processor(args)
+
+        if args.keep_generations is not None and not DRY_RUN:
+            save_backup_generations(args.keep_generations)
+
+    parser = build_common_cmd(
+        parser,
+        mount_formula,
+        pre_processor=pre_processor,
+        post_processor=post_processor,
+        concurrent=True,
+        ordered=True,
+    )
+    return parser
+
+
+# ==================================================
+# Cancel Command
+# ==================================================
+
+
+def plan_unmount_dotfile(counter, system, backup=None, mode="link"):
+    """Decide the operations to unmount a dotfile, without touching anything."""
+
+    if mode != "link":
+        return plan_uncopy_dotfile(counter, system, backup, mode)
+
+    if resolve_path(system) != counter:
+        return [{"kind": "skip-not-mounted", "path": str(system)}]
+
+    ops = [{"kind": "unlink", "path": str(system), "target": str(counter)}]
+    return ops + plan_restore_dotfile(counter, system, backup)
+
+
+def plan_uncopy_dotfile(counter, system, backup, mode):
+    """Decide the operations to remove a copied dotfile, the changed ones are kept."""
+
+    state = get_dotfile_state(counter, system, backup, mode=mode)
+    if state["system_status"] == "modified":
+        log(f"{system.name}: changed since it was copied, keep it.", logging.ERROR)
+        return [{"kind": "conflict", "path": str(system)}]
+    if state["system_status"] != "mounted":
+        return [{"kind": "skip-not-mounted", "path": str(system)}]
+
+    ops = [
+        {"kind": "remove", "path": str(system), "source": str(counter), "mode": mode}
+    ]
+    return ops + plan_restore_dotfile(counter, system, backup)
+
+
+def plan_restore_dotfile(counter, system, backup):
+    """Decide the operations to put the backup of a dotfile back."""
+
+    ops = []
+    if backup.is_symlink():
+        target = str(resolve_path(backup))
+        ops.append({"kind": "restore-symlink", "path": str(system), "target": target})
+    elif backup.is_file() or backup.is_dir() and counter.is_dir():
+        ops.append({"kind": "restore-move", "path": str(system), "source": str(backup)})
+    elif backup.exists():
+        log(f"{backup.name}: unknown existed backup dotfile.", logging.ERROR)
+        ops.append({"kind": "conflict", "path": str(backup)})
+    else:
+        log(f"{backup}: backup file not exists.", logging.WARNING)
+
+    return ops
+
+
+def unmount_dotfile(counter, system, backup=None, mode="link"):
+    ops = plan_unmount_dotfile(counter, system, backup, mode)
+    for op in ops:
+        apply_op(op)
+
+    config = {"counter": counter, "system": system, "backup": backup, "mode": mode}
+    record_dotfiles([config], ops)
+    return any(op["kind"] not in NOOP_OPS for op in ops)
+
+
+def unmount_formula(formula):
+    log(f"{FORMULA_FLAG} {formula}")
+
+    formula_info = get_formula_info(formula)
+
+    if formula_info.get("disabled", False):
+        log(f"disabled:".ljust(LEFT_JUST_WIDTH) + "True", logging.ERROR, True)
+        log(f"this formula `{formula}` is disabled.", logging.WARNING)
+        print("")
+        return
+
+    check_journal(formula)
+
+    log(f"{formula}: unmount start...", logging.INFO)
+
+    if RESTORE_GENERATION is not None:
+        if DRY_RUN:
+            log(f"{formula}: dry run, plan with the current backups.", logging.WARNING)
+        else:
+            restore_generation(formula, RESTORE_GENERATION)
+
+    if not DRY_RUN:
+        forget_formula(formula)
+    dotfiles, ops = plan_formula(formula, formula_info, plan_unmount_dotfile)
+    if execute_plan(formula, "cancel", dotfiles, ops):
+        init_backups(formula)
+
+    log(f"{formula}: unmount {'planned' if DRY_RUN else 'done'}.", logging.INFO)
+    print("")
+
+
+def add_unmount_parser(subparsers):
+    """Create the parser for the `cancel` command."""
+
+    parser = add_sub_parser(subparsers, "cancel")
+
+    parser.add_argument(
+        "--generation",
+        type=positive_int,
+        metavar="N",
+        help="restore the backups archived as generation N, instead of the current ones",
+    )
+
+    plan_pre_processor, post_processor = add_plan_arguments(parser, "cancel")
+
+    def pre_processor(args):
+        global RESTORE_GENERATION
+        RESTORE_GENERATION = args.generation
+
+        plan_pre_processor(args)
+
+    parser = build_common_cmd(
+        parser,
+        unmount_formula,
+        pre_processor=pre_processor,
+        post_processor=post_processor,
+        concurrent=True,
+        ordered=True,
+        reverse=True,
+    )
+    return parser
+
+
+# ==================================================
+# Tab Command
+# ==================================================
+
+
+def get_dotfile_record(counter, system, backup=None, mode="link"):
+    """The fields every record of a dotfile starts with."""
+
+    relative = counter.relative_to(COUNTER_PATH)
+    return {
+        "formula": relative.parts[0],
+        "dotfile": str(relative.relative_to(relative.parts[0])),
+        "counter": str(counter),
+        "system": str(system),
+        "backup": str(backup),
+        "mode": mode,
+    }
+
+
+def status_dotfile(counter, system, backup=None, mode="link"):
+    state = get_dotfile_state(counter, system, backup, verify=VERIFY, mode=mode)
+    if OUTPUT_FORMAT != "table":
+        record = get_dotfile_record(counter, system, backup, mode)
+        record["system_status"] = state["system_status"]
+        record["backup_status"] = state["backup_status"]
+        emit_record(record)
+        return
+
+    levels = {
+        "enabled": logging.INFO,
+        "mounted": logging.INFO,
+        "modified": logging.WARNING,
+        "backed-up": logging.INFO,
+        "not-mounted": logging.WARNING,
+        "not-exists": logging.WARNING,
+        "unknown-file": logging.ERROR,
+    }
+
+    print(r"@ dotfile:".ljust(LEFT_JUST_WIDTH), end="")
+    print(counter.name)
+
+    print(r"# counter:".ljust(LEFT_JUST_WIDTH), end="")
+    if not SIMPLIFY:
+        print(counter)
+        print(r"# status:".ljust(LEFT_JUST_WIDTH), end="")
+    log("enabled", levels["enabled"], True)
+
+    print(r"$ system:".ljust(LEFT_JUST_WIDTH), end="")
+    if not SIMPLIFY:
+        print(system)
+        print(r"$ status:".ljust(LEFT_JUST_WIDTH), end="")
+    log(state["system_status"], levels[state["system_status"]], True)
+
+    print(r"% backup:".ljust(LEFT_JUST_WIDTH), end="")
+    if not SIMPLIFY:
+        print(backup)
+        print(r"% status:".ljust(LEFT_JUST_WIDTH), end="")
+    log(state["backup_status"], levels[state["backup_status"]], True)
+
+    print("")
+
+
+def diff_file(counter, system, mode="link"):
+    """Compare the system file with the counter one, and count the bytes hashed.
+
+    The sizes are compared first, then the mtimes like `rsync` does unless `--verify`
+    is given, only the files left are hashed.
+    """
+
+    try:
+        system_stat = system.stat()
+    except OSError:
+        return "missing", 0
+    counter_stat = counter.stat()
+
+    # E.g. a mounted symlink, or a hard link to the counter file.
+    if os.path.samestat(counter_stat, system_stat):
+        return "identical", 0
+    if stat.S_ISDIR(counter_stat.st_mode) and stat.S_ISDIR(system_stat.st_mode):
+        return diff_tree(counter, system)
+    if not stat.S_ISREG(counter_stat.st_mode) or not stat.S_ISREG(system_stat.st_mode):
+        return "differs", 0
+
+    if mode == "template":
+        content = render_dotfile(counter, mode)
+        if system_stat.st_size != len(content):
+            return "differs", 0
+        identical = hash_file(system) == hash_content(content)
+        return ("identical" if identical else "differs"), system_stat.st_size
+
+    if system_stat.st_size != counter_stat.st_size:
+        return "differs", 0
+    if not VERIFY and system_stat.st_mtime_ns == counter_stat.st_mtime_ns:
+        return "identical", 0
+    identical = hash_file(counter) == hash_file(system)
+    return ("identical" if identical else "differs"), system_stat.st_size * 2
+
+
+def diff_tree(counter, system):
+    """Compare two directories, the system one must have the same entries."""
+
+    hashed = 0
+    for dir_path, dir_names, file_names in os.walk(counter):
+        system_dir_path = system / os.path.relpath(dir_path, counter)
+        try:
+            names = set(os.listdir(system_dir_path))
+        except OSError:
+            return "differs", hashed
+        if names != {*dir_names, *file_names}:
+            return "differs", hashed
+
+        for name in file_names:
+            status, size = diff_file(
+                pathlib.Path(dir_path, name), system_dir_path / name
+            )
+            hashed += size
+            if status != "identical":
+                return "differs", hashed
+    return "identical", hashed
+
+
+def diff_dotfile(counter, system, backup=None, mode="link"):
+    """Compare one dotfile, a file that cannot be read or rendered is an error."""
+
+    try:
+        return diff_file(counter, system, mode)
+    except KeyError as e:
+        log(
+            f"{counter.name}: ${e.args[0]} unknown environment variable.", logging.ERROR
+        )
+    except (OSError, UnicodeDecodeError) as e:
+        log(f"{counter.name}: diff error, {e}.", logging.ERROR)
+    return "error", 0
+
+
+def diff_formula(formula):
+    """Show whether the system files hold the content of the counter ones."""
+
+    import concurrent.futures
+
+    levels = {
+        "identical": logging.INFO,
+        "differs": logging.ERROR,
+        "missing": logging.WARNING,
+        "error": logging.ERROR,
+    }
+
+    configs = list(yield_dotfiles(formula, get_formula_info(formula)))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=DIFF_JOBS) as executor:
+        futures = [executor.submit(diff_dotfile, **config) for config in configs]
+        # The results are shown in order, while the rest are still being hashed.
+        for config, future in zip(configs, futures):
+            status, hashed = future.result()
+            DIFF_SUMMARY[status] += 1
+            DIFF_SUMMARY["hashed"] += hashed
+            if OUTPUT_FORMAT != "table":
+                record = get_dotfile_record(**config)
+                emit_record({**record, "diff": status, "hashed": hashed})
+                continue
+
+            print(r"@ dotfile:".ljust(LEFT_JUST_WIDTH), end="")
+            print(config["counter"].name)
+            if not SIMPLIFY:
+                print(r"# counter:".ljust(LEFT_JUST_WIDTH), end="")
+                print(config["counter"])
+                print(r"$ system:".ljust(LEFT_JUST_WIDTH), end="")
+                print(config["system"])
+            print(r"$ diff:".ljust(LEFT_JUST_WIDTH), end="")
+            log(status, levels[status], True)
+            print("")
+
+
+def report_diff():
+    """Show the totals of `tab --diff` in one line, to be added up across hosts."""
+
+    elapsed = time.perf_counter() - DIFF_STARTED
+    counts = ", ".join(f"{DIFF_SUMMARY[status]} {status}" for status in DIFF_STATUSES)
+    hashed = DIFF_SUMMARY["hashed"] / 1024 / 1024
+    drifted = any(DIFF_SUMMARY[status] for status in DIFF_STATUSES[1:])
+    log(
+        f"diff: {counts}, {hashed:.1f} MiB hashed in {elapsed:.2f}s.",
+        logging.WARNING if drifted else logging.INFO,
+    )
+
+
+def status_formula(formula):
+    log(f"{FORMULA_FLAG} {formula}")
+
+    formula_info = get_formula_info(formula)
+
+    if formula_info.get("disabled", False):
+        log(f"disabled:".ljust(LEFT_JUST_WIDTH) + "True", logging.ERROR, True)
+    print("")
+
+    if DIFF:
+        diff_formula(formula)
+    else:
+        for config in yield_dotfiles(formula, formula_info):
+            status_dotfile(**config)
+
+    print("")
+
+
+def add_status_parser(subparsers):
+    """Create the parser for the `tab` command."""
+
+    parser = add_sub_parser(subparsers, "tab")
+
+    parser.add_argument(
+        "-s",
+        "--simplify",
+        action="store_true",
+        help="simplifies the output",
+    )
+
+    parser.add_argument(
+        "--verify",
+        action="store_true",
+        help="probe every dotfile again instead of trusting the recorded status,"
+        " with `--diff` hash the files even if their sizes and mtimes are the same",
+    )
+
+    parser.add_argument(
+        "--diff",
+        action="store_true",
+        help="show whether each system file is identical to, differs from"
+        " or is missing the content of the counter file",
+    )
+
+    parser.add_argument(
+        "--diff-jobs",
+        type=positive_int,
+        default=DIFF_JOBS,
+        metavar="N",
+        help="hash up to N files at the same time (default: %(default)s)",
+    )
+
+    format_pre_processor = add_format_arguments(parser)
+
+    def pre_processor(args):
+        format_pre_processor(args)
+
+        global SIMPLIFY
+        SIMPLIFY = args.simplify
+
+        global VERIFY
+        VERIFY = args.verify
+
+        global DIFF, DIFF_JOBS, DIFF_SUMMARY, DIFF_STARTED
+        DIFF = args.diff
+        DIFF_JOBS = args.diff_jobs
+        DIFF_SUMMARY = dict.fromkeys((*DIFF_STATUSES, "hashed"), 0)
+        DIFF_STARTED = time.perf_counter()
+
+    def post_processor(args):
+        if DIFF:
+            report_diff()
+
+    parser = build_common_cmd(
+        parser,
+        status_formula,
+        pre_processor=pre_processor,
+        post_processor=post_processor,
+    )
+    return parser
+
+
+# ==================================================
+# Recover Command
+# ==================================================
+
+
+def recover_formula(formula):
+    log(f"{FORMULA_FLAG} {formula}")
+
+    journal_path = get_journal_path(formula)
+    if not journal_path.exists():
+        log(f"{formula}: nothing to recover.", logging.INFO)
+        print("")
+        return
+
+    header, done = read_journal(journal_path)
+    if header is None:
+        log(f"{formula}: nothing applied yet, discard the journal.", logging.INFO)
+        close_journal(journal_path)
+        print("")
+        return
+
+    ops = header["ops"]
+    if ROLLBACK:
+        log(f"{formula}: rollback `{header['action']}` start...", logging.INFO)
+        # The first operation not marked as done may be applied partly.
+        pending = min(set(range(len(ops))) - done, default=len(ops))
+        for op in reversed(ops[: pending + 1]):
+            undo_op(op)
+    else:
+        log(f"{formula}: replay `{header['action']}` start...", logging.INFO)
+        for index, op in enumerate(ops):
+            if index not in done:
+                apply_op(op)
+
+    dotfiles = [
+        {
+            key: value if key == "mode" else pathlib.Path(value)
+            for key, value in config.items()
+        }
+        for config in header["dotfiles"]
+    ]
+    record_dotfiles(dotfiles, [] if ROLLBACK else ops)
+    forget_formula(formula)
+    close_journal(journal_path)
+
+    log(f"{formula}: recover done.", logging.INFO)
+    print("")
+
+
+def add_recover_parser(subparsers):
+    """Create the parser for the `recover` command."""
+
+    parser = add_sub_parser(subparsers, "recover")
+
+    parser.add_argument(
+        "--rollback",
+        action="store_true",
+        help="roll back the unfinished operations instead of replaying them",
+    )
+
+    def pre_processor(args):
+        global ROLLBACK
+        ROLLBACK = args.rollback
+
+    parser = build_common_cmd(parser, recover_formula, pre_processor=pre_processor)
+    return parser
+
+
+# ==================================================
+# Serve Command
+# ==================================================
+
+
+class PollingWatcher:
+    """Wake up every interval, and let the snapshots tell what changed."""
+
+    def __init__(self, interval):
+        self.interval = interval
+
+    def watch(self, formula, snapshot):
+        pass
+
+    def wait(self, formulae):
+        time.sleep(self.interval)
+        return set(formulae)
+
+
+class InotifyWatcher:
+    """Wake up on the changes of the watched directories, by inotify via ctypes."""
+
+    def __init__(self):
+        import ctypes
+
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+
+        self.paths = {}
+        self.formulae = {}
+        self.counter_wd = self.add_watch(COUNTER_PATH, INOTIFY_COUNTER_MASK)
+
+    def add_watch(self, path, mask):
+        # Adding the same directory again just returns its watch descriptor.
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd >= 0:
+            self.paths[wd] = path
+        return wd
+
+    def watch(self, formula, snapshot):
+        # The missing system directories are watched by their nearest ancestor.
+        dir_paths = {COUNTER_PATH / formula: INOTIFY_COUNTER_MASK}
+        for config in snapshot["dotfiles"]:
+            # The nested counter directories of the `**` patterns, by their dotfiles.
+            dir_paths.setdefault(config["counter"].parent, INOTIFY_COUNTER_MASK)
+            dir_path = config["system"].parent
+            while not dir_path.is_dir() and dir_path != dir_path.parent:
+                dir_path = dir_path.parent
+            dir_paths.setdefault(dir_path, INOTIFY_MASK)
+
+        for dir_path, mask in dir_paths.items():
+            if (wd := self.add_watch(dir_path, mask)) >= 0:
+                self.formulae.setdefault(wd, set()).add(formula)
+
+    def read_events(self, formulae):
+        import struct
+
+        candidates = set()
+        data = os.read(self.fd, 64 * 1024)
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = struct.unpack_from("iIII", data, offset)
+            name = data[
+                offset + INOTIFY_EVENT_SIZE : offset + INOTIFY_EVENT_SIZE + length
+            ]
+            offset += INOTIFY_EVENT_SIZE + length
+
+            if mask & INOTIFY_OVERFLOW:
+                log("inotify: event queue overflowed, check all.", logging.WARNING)
+                candidates.update(formulae)
+            elif wd == self.counter_wd:
+                candidates.add(os.fsdecode(name.rstrip(b"\0")))
+            else:
+                candidates.update(self.formulae.get(wd, ()))
+        return candidates
+
+    def wait(self, formulae):
+        import select
+
+        select.select([self.fd], [], [])
+        candidates = set()
+        # Coalesce a burst of events, e.g. a `git checkout` inside `counter/`.
+        while select.select([self.fd], [], [], SERVE_SETTLE_TIME)[0]:
+            candidates |= self.read_events(formulae)
+        return candidates
+
+
+def open_watcher():
+    if not SERVE_POLL and sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher()
+        except (OSError, AttributeError) as e:
+            log(f"inotify: not available, {e}.", logging.WARNING)
+
+    log(f"polling the formulae every {SERVE_INTERVAL} seconds.", logging.INFO)
+    return PollingWatcher(SERVE_INTERVAL)
+
+
+def take_snapshot(formula, formula_info, dotfiles):
+    """Remember what a formula was converged against, see `is_snapshot_stale`."""
+
+    counter_dir_exists = (COUNTER_PATH / formula).is_dir()
+    return {
+        "info": formula_info,
+        "dotfiles": dotfiles,
+        "fingerprint": fingerprint_formula(formula, formula_info)
+        if counter_dir_exists
+        else None,
+        "systems": {
+            str(config["system"]): stat_fingerprint(lstat_path(config["system"]))
+            for config in dotfiles
+        },
+    }
+
+
+def is_snapshot_stale(formula, snapshot):
+    if snapshot is None:
+        return True
+
+    counter_dir_exists = (COUNTER_PATH / formula).is_dir()
+    fingerprint = (
+        fingerprint_formula(formula, snapshot["info"]) if counter_dir_exists else None
+    )
+    return fingerprint != snapshot["fingerprint"] or any(
+        stat_fingerprint(lstat_path(system)) != system_fingerprint
+        for system, system_fingerprint in snapshot["systems"].items()
+    )
+
+
+def converge_formula(formula, snapshots):
+    """Mount the dotfiles appeared or clobbered, unmount those vanished from counter."""
+
+    previous = snapshots.get(formula) or {"dotfiles": []}
+    # If it fails, the formula is tried again only after something changes.
+    snapshots[formula] = take_snapshot(formula, {}, previous["dotfiles"])
+
+    log(f"{FORMULA_FLAG} {formula}")
+
+    formula_info = {}
+    if (COUNTER_PATH / formula).is_dir():
+        formula_info = get_formula_info(formula)
+
+    if formula_info.get("disabled", False):
+        log(f"this formula `{formula}` is disabled.", logging.WARNING)
+        snapshots[formula] = take_snapshot(formula, formula_info, [])
+        print("")
+        return
+
+    check_journal(formula)
+
+    log(f"{formula}: converge start...", logging.INFO)
+
+    # Unlike `order`, the backups are not emptied, they are archived after changes.
+    (BACKUPS_PATH / formula).mkdir(parents=True, exist_ok=True)
+
+    dotfiles, ops = plan_formula(formula, formula_info, plan_mount_dotfile)
+    counters = {config["counter"] for config in dotfiles}
+    vanished = [
+        config for config in previous["dotfiles"] if config["counter"] not in counters
+    ]
+    ops = [op for config in vanished for op in plan_unmount_dotfile(**config)] + ops
+
+    if any(op["kind"] not in NOOP_OPS for op in ops):
+        execute_plan(formula, "serve", vanished + dotfiles, ops)
+        archive_backups(formula)
+    if formula_info:
+        systems = [config["system"] for config in dotfiles]
+        record_formula(formula, fingerprint_formula(formula, formula_info), systems)
+    else:
+        forget_formula(formula)
+    snapshots[formula] = take_snapshot(formula, formula_info, dotfiles)
+
+    log(f"{formula}: converge done.", logging.INFO)
+    print("")
+
+
+def serve_formulae(formulae):
+    """Converge the formulae, then keep them converged until interrupted."""
+
+    watcher = open_watcher()
+    snapshots = {}
+    candidates = set(formulae)
+
+    with grouped_streams():
+        while True:
+            # The resolved directories may have changed since the last round.
+            resolve_dir.cache_clear()
+            if SERVE_ALL:
+                # Pick up the formulae added to `counter/` since the last round.
+                candidates.update(set(load_supported_formulae()) - snapshots.keys())
+
+            for formula in sorted(candidates):
+                if not is_snapshot_stale(formula, snapshots.get(formula)):
+                    continue
+                run_formula(
+                    functools.partial(converge_formula, snapshots=snapshots), formula
+                )
+                watcher.watch(formula, snapshots[formula])
+
+            candidates = watcher.wait(snapshots.keys())
+            candidates = {
+                formula
+                for formula in candidates
+                if formula in snapshots
+                or (SERVE_ALL and (COUNTER_PATH / formula).is_dir())
+            }
+
+
+def add_serve_parser(subparsers):
+    """Create the parser for the `serve` command."""
+
+    parser = add_sub_parser(subparsers, "serve")
+
+    parser.add_argument(
+        "--poll",
+        action="store_true",
+        help="poll the files instead of watching them by inotify",
+    )
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=SERVE_INTERVAL,
+        metavar="SECONDS",
+        help="seconds between two polls (default: %(default)s)",
+    )
+
+    def pre_processor(args):
+        global SERVE_ALL
+        SERVE_ALL = args.all
+
+        global SERVE_POLL
+        SERVE_POLL = args.poll
+
+        global SERVE_INTERVAL
+        SERVE_INTERVAL = args.interval
+
+    parser = build_common_cmd(
+        parser, serve_formulae, pre_processor=pre_processor, bulk=True
+    )
+    return parser
+
+
+# ==================================================
+# Fleet Command
+# ==================================================
+
+
+def read_inventory(inventory_path):
+    """Read the hosts, one `DESTINATION [ROOT]` per line, `#` starts a comment."""
+
+    hosts = {}
+    try:
+        with open(inventory_path) as fp:
+            for line in fp:
+                fields = line.split("#", 1)[0].split()
+                if fields:
+                    root = fields[1] if len(fields) > 1 else FLEET_ROOT
+                    hosts[fields[0]] = {"name": fields[0], "root": root}
+    except OSError as e:
+        log(f"{inventory_path}: read error, {e}.", logging.ERROR)
+        raise ProgramError()
+
+    if not hosts:
+        log(f"{inventory_path}: no host found.", logging.ERROR)
+        raise ProgramError()
+    return hosts
+
+
+def build_payload():
+    """Pack the scripts and `counter/` once, the fingerprint ignores their mtimes."""
+
+    import gzip
+    import hashlib
+    import io
+    import tarfile
+
+    digest = hashlib.sha256()
+
+    def add_member(tarinfo):
+        if "__pycache__" in tarinfo.name.split("/"):
+            return None
+        digest.update(f"{tarinfo.name}:{tarinfo.type}:{tarinfo.mode}:".encode())
+        digest.update(f"{tarinfo.linkname}\n".encode())
+        if tarinfo.isfile():
+            with open(ROOT_PATH / tarinfo.name, "rb") as fp:
+                digest.update(hashlib.sha256(fp.read()).digest())
+        tarinfo.uid = tarinfo.gid = 0
+        tarinfo.uname = tarinfo.gname = ""
+        return tarinfo
+
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w") as tar:
+        for filename in FLEET_SCRIPT_FILENAMES:
+            tar.add(ROOT_PATH / filename, arcname=filename, filter=add_member)
+        tar.add(COUNTER_PATH, arcname=COUNTER_DIRNAME, filter=add_member)
+        for dirname in (DATABASES_DIRNAME, LOGS_DIRNAME, BACKUPS_DIRNAME):
+            tar.add(ROOT_PATH / dirname, arcname=dirname, recursive=False)
+
+    return gzip.compress(buffer.getvalue(), mtime=0), digest.hexdigest()
+
+
+def run_on_host(host, command, payload=b""):
+    """Run a shell command on a host, from its home directory."""
+
+    import subprocess
+    import tempfile
+
+    options = {}
+    if FLEET_TRANSPORT == "local":
+        # Stand-in for SSH, every host is a home directory on this machine.
+        home_path = FLEET_LOCAL_PATH / host["name"]
+        home_path.mkdir(parents=True, exist_ok=True)
+        cmd = ["sh", "-c", command]
+        options = {"cwd": home_path, "env": {**os.environ, "HOME": str(home_path)}}
+    else:
+        control_path = pathlib.Path(tempfile.gettempdir()) / "dotpub-ssh-%C"
+        cmd = ["ssh", *FLEET_SSH_OPTIONS, "-o", f"ControlPath={control_path}"]
+        cmd += [host["name"], command]
+
+    completed = subprocess.run(
+        cmd, input=payload, capture_output=True, timeout=FLEET_TIMEOUT, **options
+    )
+    if completed.returncode != 0:
+        lines = completed.stderr.decode(errors="replace").strip().splitlines()
+        log(
+            f"{host['name']}: `{command}` failed, {' '.join(lines[-3:])}", logging.ERROR
+        )
+        raise ProgramError()
+    return completed.stdout.decode(errors="replace")
+
+
+def count_statuses(output):
+    """Count the system statuses of the records written by `tab --format ndjson`."""
+
+    statuses = {}
+    for line in output.splitlines():
+        try:
+            status = json.loads(line)["system_status"]
+        except (ValueError, KeyError, TypeError):
+            continue
+        statuses[status] = statuses.get(status, 0) + 1
+    return statuses
+
+
+def fleet_host(name, hosts, payload, fingerprint, command, formulae, results):
+    import shlex
+
+    log(f"{HOST_FLAG} {name}")
+
+    host = hosts[name]
+    result = results[name] = {"payload": "-", command: "-", "statuses": {}}
+    started = time.perf_counter()
+
+    root = shlex.quote(host["root"])
+    fingerprint_path = f"{root}/{FLEET_FINGERPRINT_FILENAME}"
+    result["payload"] = "failed"
+    if run_on_host(host, f"cat {fingerprint_path} 2>/dev/null || true") == fingerprint:
+        result["payload"] = "unchanged"
+    else:
+        run_on_host(
+            host,
+            f"rm -rf {root}/{COUNTER_DIRNAME} && mkdir -p {root}"
+            f" && tar -xzf - -C {root} && printf %s {fingerprint} > {fingerprint_path}",
+            payload,
+        )
+        result["payload"] = "shipped"
+    log(f"{name}: payload {result['payload']}.", logging.INFO)
+
+    publican = f"cd {root} && {shlex.quote(FLEET_PYTHON)} publican.py"
+    arguments = shlex.join(formulae)
+    result[command] = "failed"
+    if command == "order":
+        run_on_host(host, f"{publican} order --incremental {arguments}")
+        log(f"{name}: order done.", logging.INFO)
+
+    output = run_on_host(host, f"{publican} tab --format ndjson {arguments}")
+    result["statuses"] = count_statuses(output)
+    result[command] = "done"
+    result["elapsed"] = time.perf_counter() - started
+    log(f"{name}: tab done.", logging.INFO)
+    print("")
+
+
+def show_fleet_summary(hosts, command, results):
+    columns = ("host", "payload", command, "mounted", "elapsed")
+    print("".join(map(str.ljust, columns, FLEET_JUST_WIDTHS)).rstrip())
+
+    for name in hosts:
+        result = results.get(name, {"payload": "-", command: "-", "statuses": {}})
+        statuses = result["statuses"]
+        total = sum(statuses.values())
+        cells = (
+            name,
+            result["payload"],
+            result[command],
+            f"{statuses.get('mounted', 0)}/{total}" if total else "-",
+            f"{result['elapsed']:.2f}s" if "elapsed" in result else "-",
+        )
+        line = "".join(map(str.ljust, cells, FLEET_JUST_WIDTHS)).rstrip()
+        mounted = total and statuses.get("mounted", 0) == total
+        log(line, logging.INFO if mounted else logging.WARNING, True)
+    print("")
+
+
+def fleet_formulae(formulae):
+    """Ship the payload to every host, then mount and check the formulae there."""
+
+    hosts = read_inventory(FLEET_INVENTORY)
+    payload, fingerprint = build_payload()
+    log(f"payload: {len(payload)} bytes, fingerprint {fingerprint[:12]}.", logging.INFO)
+    print("")
+
+    results = {}
+    action = functools.partial(
+        fleet_host,
+        hosts=hosts,
+        payload=payload,
+        fingerprint=fingerprint,
+        command=FLEET_COMMAND,
+        formulae=formulae,
+        results=results,
+    )
+    try:
+        run_concurrently(
+            action, list(hosts), FLEET_JOBS, graph=dict.fromkeys(hosts, ())
+        )
+    finally:
+        show_fleet_summary(hosts, FLEET_COMMAND, results)
+
+
+def add_fleet_parser(subparsers):
+    """Create the parser for the `fleet` command."""
+
+    import tempfile
+
+    parser = add_sub_parser(subparsers, "fleet")
+
+    parser.add_argument(
+        "command",
+        choices=FLEET_COMMANDS,
+        metavar="COMMAND",
+        help=f"command to run on every host, one of: {', '.join(FLEET_COMMANDS)}",
+    )
+    parser.add_argument(
+        "--inventory",
+        required=True,
+        metavar="PATH",
+        help="file of the hosts, one `DESTINATION [ROOT]` per line",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=positive_int,
+        default=FLEET_JOBS,
+        metavar="N",
+        help="reach up to N hosts at the same time (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--transport",
+        choices=FLEET_TRANSPORTS,
+        default=FLEET_TRANSPORT,
+        help="reach the hosts by SSH, or by local home directories for testing",
+    )
+    parser.add_argument(
+        "--local-path",
+        type=pathlib.Path,
+        default=pathlib.Path(tempfile.gettempdir()) / "dotpub-fleet",
+        metavar="PATH",
+        help="where the home directories of the local transport live",
+    )
+    parser.add_argument(
+        "--python",
+        default=FLEET_PYTHON,
+        help="python on the hosts (default: %(default)s)",
+    )
+
+    def pre_processor(args):
+        global FLEET_COMMAND
+        FLEET_COMMAND = args.command
+
+        global FLEET_INVENTORY
+        FLEET_INVENTORY = args.inventory
+
+        global FLEET_JOBS
+        FLEET_JOBS = args.jobs
+
+        global FLEET_TRANSPORT
+        FLEET_TRANSPORT = args.transport
+
+        global FLEET_LOCAL_PATH
+        FLEET_LOCAL_PATH = args.local_path.resolve()
+
+        global FLEET_PYTHON
+        FLEET_PYTHON = args.python
+
+    parser = build_common_cmd(
+        parser, fleet_formulae, pre_processor=pre_processor, bulk=True
+    )
+    return parser
+
+
+# ==================================================
+# Main
+# ==================================================
+
+
+def init_sub_parser(parser):
+    """Create the sub-level parser."""
+
+    subparsers = parser.add_subparsers(
+        title="subcommands",
+        metavar="ACTION",
+        description="Chose the action you want to execute.",
+    )
+    return subparsers
+
+
+def init_top_parser():
+    """Create the top-level parser."""
+
+    parser = argparse.ArgumentParser(
+        description="Serve fruity dotfiles for brew fans!",
+        epilog=f"%(prog)s, version: {VERSION}, maintainer: KevInZhao.",
+    )
+    parser.add_argument(
+        "-v",
+        "--version",
+        action="version",
+        version=VERSION,
+    )
+    parser.add_argument(
+        "--log-format",
+        choices=LOG_FORMATS,
+        default=LOG_FORMAT,
+        help="print the output as colored text or as JSON lines (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--stats",
+        action="store_true",
+        help="time the stages and count the filesystem operations of each formula",
+    )
+    parser.add_argument(
+        "--stats-format",
+        choices=STATS_FORMATS,
+        default=STATS_FORMAT,
+        help="print the stats as a table or as JSON (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--profile-startup",
+        action="store_true",
+        help="report how long each startup phase takes",
+    )
+    return parser
+
+
+def init_logger(log_format):
+    global LOG_FORMAT
+    LOG_FORMAT = log_format
+
+    global STDOUT_COLORED, STDERR_COLORED
+    colored = log_format == "text" and "NO_COLOR" not in os.environ
+    STDOUT_COLORED = colored and sys.stdout.isatty()
+    STDERR_COLORED = colored and sys.stderr.isatty()
+
+    LOGGER.setLevel(logging.INFO)
+    fmt = "%(asctime)s - %(levelname)s: %(message)s"
+
+    if log_format == "json":
+        # `log` writes every record to `stdout`, the plain lines are wrapped too.
+        sys.stdout = JsonLinesStream(sys.stdout)
+    else:
+        stream_handler = logging.StreamHandler()
+        stream_handler.setFormatter(ColoredFormatter(fmt))
+        LOGGER.addHandler(stream_handler)
+
+    # Nothing is written for most runs, so the file is opened on the first record.
+    file_handler = logging.FileHandler(str(LOGS_PATH / LOGS_FILENAME), delay=True)
+    file_handler.setFormatter(logging.Formatter(fmt))
+    LOGGER.addHandler(BackgroundHandler(file_handler))
+
+
+def mark_startup(phase):
+    STARTUP_MARKS.append((phase, time.perf_counter()))
+
+
+def report_startup():
+    print("startup profile:", file=sys.stderr)
+
+    previous = STARTED_AT
+    for phase, moment in STARTUP_MARKS:
+        print(
+            f"{phase}:".ljust(LEFT_JUST_WIDTH)
+            + f"{(moment - previous) * 1000:8.2f} ms",
+            file=sys.stderr,
+        )
+        previous = moment
+
+    print(
+        "total:".ljust(LEFT_JUST_WIDTH) + f"{(previous - STARTED_AT) * 1000:8.2f} ms",
+        file=sys.stderr,
+    )
+
+
+def main():
+    """Run administrative tasks."""
+
+    if sys.argv[1:2] == ["complete"]:
+        if not complete(sys.argv[2:]):
+            # The index is missing or stale, rebuild it and answer again.
+            dump_completion_index(get_supported_formulae())
+            complete(sys.argv[2:])
+        return
+
+    mark_startup("imports")
+
+    parser = init_top_parser()
+    subparsers = init_sub_parser(parser)
+
+    # Only the chosen action needs its full parser, the others are listed in help.
+    builders = {
+        "brew": add_manage_parser,
+        "menu": add_list_parser,
+        "order": add_mount_parser,
+        "cancel": add_unmount_parser,
+        "tab": add_status_parser,
+        "recover": add_recover_parser,
+        "serve": add_serve_parser,
+        "fleet": add_fleet_parser,
+    }
+    arguments = get_positionals(sys.argv[1:], VALUED_OPTIONS)
+    for action in ACTIONS:
+        if arguments and arguments[0] == action:
+            builders[action](subparsers)
+        else:
+            add_sub_parser(subparsers, action)
+    mark_startup("parser")
+
+    try:
+        # Parse the arguments and call whatever function was selected.
+        args = parser.parse_args()
+        mark_startup("parse")
+
+        init_logger(args.log_format)
+        mark_startup("logger")
+
+        if args.stats:
+            enable_stats(args.stats_format)
+
+        args.handler(args)
+        mark_startup("handler")
+    finally:
+        if STATS is not None:
+            report_stats()
+        if "--profile-startup" in sys.argv[1:]:
+            report_startup()
+
+
+def launch(started_at):
+    """Run `main` for `publican.py`, and return the exit status."""
+
+    global STARTED_AT
+    STARTED_AT = started_at
+
+    try:
+        main()
+    except KeyboardInterrupt:
+        print("")
+        log(f"program interrupted by user.", logging.ERROR)
+        if JOURNALS_PATH.exists() and any(JOURNALS_PATH.glob(f"*{JOURNAL_SUFFIX}")):
+            log(
+                "unfinished journals found, please run `recover --all`.",
+                logging.WARNING,
+            )
+        return 1
+    except ProgramError:
+        log(f"program exited by self.", logging.ERROR)
+        return 1
+    else:
+        return 0
@@ -10,7 +10,11 @@
 # Note:
 #   You need Python 3.9 or greater to run the following script.
 # Sections:
+#   - Constants
 #   - Test and Debug
+#   - Tests
+#   - Benchmark
+#   - Main
 # Repository:
 #   - [DotPub](https://github.com/hellozhaowenkai/dotpub/)
 # References:
@@ -19,7 +23,115 @@
 # ==================================================
 
 
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import logging
+import pathlib
+import argparse
+import platform
+import tempfile
+import statistics
 import subprocess
+import contextlib
+import importlib.util
+
+
+# ==================================================
+# Constants
+# ==================================================
+
+
+ROOT_PATH = pathlib.Path(__file__).resolve().parent
+PUBLICAN_FILENAME = "publican.py"
+DOTPUB_FILENAME = "dotpub.py"
+COMPLETION_FILENAME = "completion.py"
+SCRIPT_FILENAMES = (PUBLICAN_FILENAME, DOTPUB_FILENAME, COMPLETION_FILENAME)
+
+BENCH_DIRNAMES = ["counter", "backups", "databases", "logs"]
+BENCH_PATTERNS = {
+    ".rc-*": ["~"],
+    ".conf-*": ["~", ".config", "{formula}"],
+    "*.toml": ["$BENCH_HOME", ".local", "share", "{formula}"],
+}
+BENCH_COMMANDS = {
+    "menu": ["menu", "--all"],
+    "menu-simplify": ["menu", "--simplify", "--all"],
+    "order": ["order", "--all"],
+    "order-incremental": ["order", "--incremental", "--all"],
+    "tab": ["tab", "--all"],
+    "tab-verify": ["tab", "--verify", "--all"],
+    "cancel": ["cancel", "--all"],
+    "brew": ["brew", "info", "--force", "--jobs", "4", "--all"],
+}
+FAKE_BREW = """#!/bin/sh
+# A fake brew, it just echoes what it is asked for.
+for bottle in "$@"; do
+  echo "==> $bottle"
+done
+"""
+TEST_FORMULAE = {
+    "vim": {
+        "info": {"name": "Vim", "path": {".vimrc": ["~"], ".gvimrc": ["~"]}},
+        "files": {".vimrc": "set number\n", ".gvimrc": "set guifont=Menlo\n"},
+    },
+}
+TEST_HOME_FILES = {".vimrc": "old\n"}
+TEST_TEMPLATE = (
+    "cost=$$5\n"
+    "shell=$1 $PS1\n"
+    "value=${DOTPUB_TEST_VALUE}\n"
+    "unset=${DOTPUB_TEST_UNSET:-unset default}\n"
+    "empty=${DOTPUB_TEST_EMPTY:-empty default}\n"
+)
+TEST_RENDERED = (
+    "cost=$5\n"
+    "shell=$1 $PS1\n"
+    "value=a value\n"
+    "unset=unset default\n"
+    "empty=empty default\n"
+)
+TEST_BREW_FORMULAE = {
+    name: {"info": {"name": name.title(), "path": {}}}
+    for name in ["vim", "git", "broken", "long"]
+}
+TEST_BREW = """#!/bin/sh
+# A fake brew, it logs its calls and fails for the bottle named "broken".
+bin_path="$(dirname "$0")"
+echo "start $*" >> "$bin_path/brew.log"
+if [ "$1" = "--cache" ]; then
+  shift
+  for bottle in "$@"; do
+    echo "$bin_path/cache/$bottle"
+  done
+  exit 0
+fi
+command="$1"
+shift
+for bottle in "$@"; do
+  echo "==> $command $bottle"
+  if [ "$command" = "fetch" ]; then
+    mkdir -p "$bin_path/cache"
+    head -c 1048576 /dev/zero > "$bin_path/cache/$bottle"
+  fi
+  if [ "$bottle" = "long" ]; then
+    head -c 2000000 /dev/zero | tr '\\0' x
+    echo
+  fi
+  sleep "${FAKE_BREW_SLEEP:-0}"
+  echo "==> $bottle $command done"
+done
+echo "end $command $*" >> "$bin_path/brew.log"
+for bottle in "$@"; do
+  if [ "$bottle" = "broken" ]; then
+    echo "Error: $bottle is broken"
+    exit 1
+  fi
+done
+"""
 
 
 # ==================================================
@@ -33,7 +145,7 @@ def run(
     return subprocess.Popen(command)
 
 
-def main():
+def debug():
     command = [
         "python",
         "publican.py",
@@ -50,5 +162,727 @@ def main():
     run(command).communicate()
 
 
+# ==================================================
+# Tests
+# ==================================================
+
+
+class TestFailure(Exception):
+    pass
+
+
+def expect(condition, message):
+    if not condition:
+        raise TestFailure(message)
+
+
+def make_test_root(root_path, formulae=None, home_files=None, brew=FAKE_BREW):
+    """Set up a DotPub of its own with a HOME, return the environment to run it in."""
+
+    for dirname in BENCH_DIRNAMES:
+        (root_path / dirname).mkdir(parents=True, exist_ok=True)
+    for filename in SCRIPT_FILENAMES:
+        shutil.copy(ROOT_PATH / filename, root_path / filename)
+
+    formulae = TEST_FORMULAE if formulae is None else formulae
+    for formula, spec in formulae.items():
+        counter_dir_path = root_path / "counter" / formula
+        counter_dir_path.mkdir(parents=True)
+        with (counter_dir_path / "formula-info.json").open("w") as fp:
+            json.dump(spec["info"], fp, indent=2)
+        write_files(counter_dir_path, spec.get("files", {}))
+
+    home_path = root_path / "home"
+    bin_path = root_path / "bin"
+    home_path.mkdir()
+    bin_path.mkdir()
+    write_files(home_path, TEST_HOME_FILES if home_files is None else home_files)
+
+    brew_path = bin_path / "brew"
+    brew_path.write_text(brew)
+    brew_path.chmod(0o755)
+
+    env = os.environ.copy()
+    env["HOME"] = str(home_path)
+    env["PATH"] = os.pathsep.join([str(bin_path), env.get("PATH", "")])
+    env["NO_COLOR"] = "1"
+    return env
+
+
+def write_files(dir_path, files):
+    for name, content in files.items():
+        (dir_path / name).parent.mkdir(parents=True, exist_ok=True)
+        (dir_path / name).write_text(content)
+
+
+def run_publican(root_path, env, *arguments, returncode=0):
+    """Run publican, its output is returned as one text with `stderr` in it."""
+
+    completed_process = subprocess.run(
+        [sys.executable, PUBLICAN_FILENAME, *arguments],
+        cwd=root_path,
+        env=env,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+    )
+    expect(
+        completed_process.returncode == returncode,
+        f"`{' '.join(arguments)}` exited with {completed_process.returncode}, "
+        f"not {returncode}:\n{completed_process.stdout}",
+    )
+    return completed_process.stdout
+
+
+def read_link(path):
+    return os.readlink(path) if os.path.islink(path) else None
+
+
+def test_journal_replay(root_path):
+    """An `order` stopped between its backup and its symlink is replayed by `recover`."""
+
+    env = make_test_root(root_path)
+    home_path = root_path / "home"
+    plan_path = root_path / "plan.json"
+    run_publican(
+        root_path, env, "order", "--dry-run", "--plan-json", str(plan_path), "vim"
+    )
+    with plan_path.open() as fp:
+        ops = json.load(fp)["formulae"]["vim"]
+    kinds = [op["kind"] for op in ops]
+    expect("backup-move" in kinds, f"nothing to back up in the plan {kinds}")
+
+    # What a crash right after the backup of `.vimrc` leaves behind.
+    moved = kinds.index("backup-move") + 1
+    apply_ops(ops[:moved])
+    write_journal(root_path, "order", ops, done=range(moved))
+
+    output = run_publican(root_path, env, "order", "vim", returncode=1)
+    expect("unfinished journal found" in output, f"journal not noticed:\n{output}")
+
+    run_publican(root_path, env, "recover", "vim")
+    counter_dir_path = root_path / "counter" / "vim"
+    expect(
+        read_link(home_path / ".vimrc") == str(counter_dir_path / ".vimrc"),
+        "`.vimrc` is not mounted by the replay",
+    )
+    expect(
+        read_link(home_path / ".gvimrc") == str(counter_dir_path / ".gvimrc"),
+        "`.gvimrc` is not mounted by the replay",
+    )
+    backup_path = pathlib.Path(ops[moved - 1]["path"])
+    expect(backup_path.read_text() == "old\n", "the backup is lost by the replay")
+    expect(not any((root_path / "databases" / "journals").iterdir()), "journal left")
+
+    run_publican(root_path, env, "cancel", "vim")
+    expect((home_path / ".vimrc").read_text() == "old\n", "`.vimrc` is not restored")
+
+
+def test_journal_rollback(root_path):
+    """`recover --rollback` undoes the operations of a stopped `order`."""
+
+    env = make_test_root(root_path)
+    home_path = root_path / "home"
+    plan_path = root_path / "plan.json"
+    run_publican(
+        root_path, env, "order", "--dry-run", "--plan-json", str(plan_path), "vim"
+    )
+    with plan_path.open() as fp:
+        ops = json.load(fp)["formulae"]["vim"]
+    moved = [op["kind"] for op in ops].index("backup-move") + 1
+
+    # The symlink is made, but the crash comes before it is marked as done.
+    apply_ops(ops[: moved + 1])
+    write_journal(root_path, "order", ops, done=range(moved))
+
+    run_publican(root_path, env, "recover", "--rollback", "vim")
+    expect(read_link(home_path / ".vimrc") is None, "`.vimrc` is still a symlink")
+    expect((home_path / ".vimrc").read_text() == "old\n", "`.vimrc` is not restored")
+    expect(not os.path.lexists(home_path / ".gvimrc"), "`.gvimrc` is left mounted")
+
+
+def test_transaction_rollback(root_path):
+    """A failed operation rolls back those applied before it, and leaves no journal."""
+
+    formulae = {
+        "vim": {
+            "info": {
+                "name": "Vim",
+                # A file is in the way of the directory, its mkdir fails.
+                "path": {".vimrc": ["~"], ".gvimrc": ["~", "vim"]},
+            },
+            "files": TEST_FORMULAE["vim"]["files"],
+        },
+    }
+    env = make_test_root(root_path, formulae, {**TEST_HOME_FILES, "vim": "a file\n"})
+    home_path = root_path / "home"
+
+    output = run_publican(root_path, env, "order", "vim", returncode=1)
+    expect("error, [Errno" in output, f"no operation failed:\n{output}")
+    expect(read_link(home_path / ".vimrc") is None, "`.vimrc` is still a symlink")
+    expect((home_path / ".vimrc").read_text() == "old\n", "`.vimrc` is not restored")
+    expect(not any((root_path / "databases" / "journals").iterdir()), "journal left")
+
+
+def apply_ops(ops):
+    """Apply the planned operations as publican would, up to a simulated crash."""
+
+    for op in ops:
+        path = pathlib.Path(op["path"])
+        if op["kind"] == "mkdir":
+            path.mkdir(parents=True, exist_ok=True)
+        elif op["kind"] == "backup-move":
+            pathlib.Path(op["source"]).replace(path)
+        elif op["kind"] == "symlink":
+            path.symlink_to(op["target"])
+        else:
+            raise TestFailure(f"unexpected operation {op}")
+
+
+def read_brew_log(root_path):
+    with (root_path / "bin" / "brew.log").open() as fp:
+        return fp.read().splitlines()
+
+
+def test_brew_parallel(root_path):
+    """The read-only brew commands run at the same time, each output in one piece."""
+
+    env = make_test_root(root_path, TEST_BREW_FORMULAE, {}, TEST_BREW)
+    env["FAKE_BREW_SLEEP"] = "0.5"
+
+    output = run_publican(
+        root_path, env, "brew", "-f", "-j", "2", "fetch", "vim", "git"
+    )
+    calls = read_brew_log(root_path)
+    expect(
+        [call.split()[0] for call in calls] == ["start", "start", "end", "end"],
+        f"the fetches did not overlap: {calls}",
+    )
+    for bottle in ["vim", "git"]:
+        expect(
+            f"==> fetch {bottle}\n==> {bottle} fetch done\n" in output,
+            f"the output of {bottle} is not in one piece:\n{output}",
+        )
+    expect("[2/2]" in output, f"no progress is reported:\n{output}")
+    expect(
+        re.search(r"^vim: +done$", output, re.M)
+        and re.search(r"^git: +done$", output, re.M),
+        f"no result is reported:\n{output}",
+    )
+
+
+def test_brew_errors(root_path):
+    """A failed or overlong brew run is an error of its formula, the others go on."""
+
+    env = make_test_root(root_path, TEST_BREW_FORMULAE, {}, TEST_BREW)
+
+    output = run_publican(
+        root_path, env, "brew", "-f", "install", "broken", "long", "vim"
+    )
+    expect("Error: broken is broken" in output, f"the output is lost:\n{output}")
+    expect("a line longer than" in output, f"the long line is not cut:\n{output}")
+    expect("==> long install done" in output, f"the rest is not read:\n{output}")
+    for formula, result in [("broken", "error"), ("long", "error"), ("vim", "done")]:
+        expect(
+            re.search(rf"^{formula}: +{result}$", output, re.M),
+            f"{formula} is not reported as {result}:\n{output}",
+        )
+    expect(len(read_brew_log(root_path)) == 6, "not every formula is run")
+
+
+def test_brew_prefetch(root_path):
+    """With `--prefetch`, every bottle is downloaded before the first install."""
+
+    env = make_test_root(root_path, TEST_BREW_FORMULAE, {}, TEST_BREW)
+
+    output = run_publican(
+        root_path, env, "brew", "-f", "--prefetch", "install", "vim", "git"
+    )
+    calls = [call.split()[:2] for call in read_brew_log(root_path)]
+    installs = calls.index(["start", "install"])
+    expect(
+        sorted(call[1] for call in calls[:installs]) == ["--cache", *["fetch"] * 4],
+        f"the bottles are not prefetched first: {calls}",
+    )
+    for formula in ["vim", "git"]:
+        expect(
+            re.search(rf"^{formula}: +[0-9.]+s +1\.00 MiB$", output, re.M),
+            f"no time and size of {formula} in the report:\n{output}",
+        )
+
+
+def test_fleet_local(root_path):
+    """The payload is shipped once to every host, then the formulae are mounted there."""
+
+    env = make_test_root(root_path)
+    inventory_path = root_path / "inventory"
+    inventory_path.write_text("host-a\nhost-b  dotpub  # a root of its own\n")
+    fleet = [
+        "fleet",
+        "--inventory",
+        str(inventory_path),
+        "--transport",
+        "local",
+        "--local-path",
+        str(root_path / "fleet"),
+        "--python",
+        sys.executable,
+    ]
+
+    output = run_publican(root_path, env, *fleet, "order", "vim")
+    for host, root in [("host-a", ".dotpub"), ("host-b", "dotpub")]:
+        home_path = root_path / "fleet" / host
+        expect(
+            read_link(home_path / ".vimrc")
+            == str(home_path / root / "counter" / "vim" / ".vimrc"),
+            f"vim is not mounted on {host}:\n{output}",
+        )
+        expect(
+            re.search(rf"^{host} +shipped +done +2/2 ", output, re.M),
+            f"{host} is not reported as shipped and mounted:\n{output}",
+        )
+
+    output = run_publican(root_path, env, *fleet, "tab", "vim")
+    for host in ["host-a", "host-b"]:
+        expect(
+            re.search(rf"^{host} +unchanged +done +2/2 ", output, re.M),
+            f"the payload is shipped again to {host}:\n{output}",
+        )
+
+
+def test_template(root_path):
+    """A template renders `${VAR}` and `${VAR:-default}`, keeps `$$` and a bare `$VAR`."""
+
+    formulae = {
+        "zsh": {
+            "info": {
+                "name": "Zsh",
+                "path": {".zshrc": {"path": ["~"], "mode": "template"}},
+            },
+            "files": {".zshrc": TEST_TEMPLATE},
+        },
+    }
+    env = make_test_root(root_path, formulae, {})
+    env["DOTPUB_TEST_VALUE"] = "a value"
+    env["DOTPUB_TEST_EMPTY"] = ""
+    env.pop("DOTPUB_TEST_UNSET", None)
+
+    run_publican(root_path, env, "order", "zsh")
+    content = (root_path / "home" / ".zshrc").read_text()
+    expect(content == TEST_RENDERED, f"the template is rendered as:\n{content}")
+
+    output = run_publican(root_path, env, "tab", "zsh")
+    expect("mounted" in output, f"the rendered template is not mounted:\n{output}")
+    env["DOTPUB_TEST_VALUE"] = "another value"
+    run_publican(root_path, env, "order", "--incremental", "zsh")
+    content = (root_path / "home" / ".zshrc").read_text()
+    expect(
+        "value=another value\n" in content, f"a new value is not rendered:\n{content}"
+    )
+
+
+def test_recursive_pattern(root_path):
+    """A `**` pattern keeps the structure below its base, which stays in the formula."""
+
+    formulae = {
+        "nvim": {
+            "info": {
+                "name": "Neovim",
+                "path": {
+                    "lua/**/*.lua": ["~", ".config", "nvim", "lua"],
+                    "../vim/**": ["~", "escaped"],
+                },
+            },
+            "files": {
+                "lua/init.lua": "",
+                "lua/plugins/git.lua": "",
+                "lua/plugins/deep/lsp.lua": "",
+                "lua/plugins/README.md": "",
+            },
+        },
+        **TEST_FORMULAE,
+    }
+    env = make_test_root(root_path, formulae, {})
+
+    output = run_publican(root_path, env, "order", "nvim")
+    counter_path = root_path / "counter" / "nvim" / "lua"
+    lua_path = root_path / "home" / ".config" / "nvim" / "lua"
+    for name in ["init.lua", "plugins/git.lua", "plugins/deep/lsp.lua"]:
+        expect(
+            read_link(lua_path / name) == str(counter_path / name),
+            f"{name} is not mounted:\n{output}",
+        )
+    expect(
+        not os.path.lexists(lua_path / "plugins" / "README.md"),
+        "a file `*.lua` does not match is mounted",
+    )
+    expect(
+        not os.path.lexists(root_path / "home" / "escaped"),
+        "a base with `..` leads out of the formula",
+    )
+    expect("outside dotfile" in output, f"the `..` base is not warned:\n{output}")
+
+
+def test_json_records(root_path):
+    """A JSON array stays valid when a formula fails partway."""
+
+    formulae = {"broken": {"info": {"name": "Broken", "path": {}}}, **TEST_FORMULAE}
+    env = make_test_root(root_path, formulae)
+    (root_path / "counter" / "broken" / "formula-info.json").write_text("{")
+
+    process = subprocess.run(
+        [sys.executable, "publican.py", "tab", "--format", "json", "vim", "broken"],
+        cwd=root_path,
+        env=env,
+        stdin=subprocess.DEVNULL,
+        capture_output=True,
+        text=True,
+    )
+    expect(process.returncode == 1, "the broken formula did not fail the run")
+    try:
+        records = json.loads(process.stdout)
+    except ValueError:
+        raise TestFailure(f"the records are not valid JSON:\n{process.stdout}")
+    expect(
+        sorted(record["dotfile"] for record in records) == [".gvimrc", ".vimrc"],
+        f"the records of vim are lost: {records}",
+    )
+
+
+def write_journal(root_path, action, ops, done):
+    """Write the journal an interrupted run of the `vim` test formula leaves behind."""
+
+    counter_dir_path = root_path / "counter" / "vim"
+    header = {
+        "formula": "vim",
+        "action": action,
+        "dotfiles": [
+            {
+                "counter": str(counter_dir_path / name),
+                "system": str(root_path / "home" / name),
+                "backup": str(root_path / "backups" / "vim" / name),
+                "mode": "link",
+            }
+            for name in TEST_FORMULAE["vim"]["files"]
+        ],
+        "ops": ops,
+    }
+    journals_path = root_path / "databases" / "journals"
+    journals_path.mkdir(parents=True, exist_ok=True)
+    with (journals_path / "vim.journal").open("w") as fp:
+        fp.write(json.dumps(header) + "\n")
+        fp.writelines(json.dumps({"done": index}) + "\n" for index in done)
+
+
+def test(args):
+    """Run the behaviour tests, each against a DotPub of its own."""
+
+    tests = {
+        name[len("test_") :]: function
+        for name, function in globals().items()
+        if name.startswith("test_") and callable(function)
+    }
+    if unknown := sorted(set(args.names) - set(tests)):
+        print(f"unknown tests {unknown}, those are known: {list(tests)}.")
+        sys.exit(2)
+
+    failed = []
+    for name, function in tests.items():
+        if args.names and name not in args.names:
+            continue
+
+        started = time.perf_counter()
+        with tempfile.TemporaryDirectory(prefix="dotpub-test-") as tmp_dir:
+            try:
+                function(pathlib.Path(tmp_dir).resolve())
+            except Exception as e:
+                failed.append(name)
+                print(f"{name}:".ljust(32) + "FAIL")
+                print(f"  {e}" if isinstance(e, TestFailure) else f"  {e!r}")
+                continue
+        print(f"{name}:".ljust(32) + f"ok {time.perf_counter() - started:8.2f}s")
+
+    if failed:
+        print(f"{len(failed)} failed: {failed}.")
+        sys.exit(1)
+
+
+# ==================================================
+# Benchmark
+# ==================================================
+
+
+def make_bench_root(root_path, formulae, dotfiles):
+    """Generate a synthetic DotPub with its own counter, and a HOME to mount into."""
+
+    for dirname in BENCH_DIRNAMES:
+        (root_path / dirname).mkdir(parents=True, exist_ok=True)
+    for filename in SCRIPT_FILENAMES:
+        shutil.copy(ROOT_PATH / filename, root_path / filename)
+
+    home_path = root_path / "home"
+    bin_path = root_path / "bin"
+    home_path.mkdir()
+    bin_path.mkdir()
+
+    brew_path = bin_path / "brew"
+    brew_path.write_text(FAKE_BREW)
+    brew_path.chmod(0o755)
+
+    patterns = list(BENCH_PATTERNS)
+    for index in range(formulae):
+        formula = f"formula-{index:04d}"
+        counter_dir_path = root_path / "counter" / formula
+        counter_dir_path.mkdir()
+
+        formula_info = {
+            "name": formula.title(),
+            "version": "1.0.0",
+            "description": "Synthetic formula for the benchmark",
+            "website": "https://example.com/",
+            "path": {
+                pattern: [segment.format(formula=formula) for segment in segments]
+                for pattern, segments in BENCH_PATTERNS.items()
+            },
+        }
+        with (counter_dir_path / "formula-info.json").open("w") as fp:
+            json.dump(formula_info, fp, indent=2)
+
+        for number in range(dotfiles):
+            pattern = patterns[number % len(patterns)]
+            name = pattern.replace("*", f"{index:04d}-{number:04d}")
+            (counter_dir_path / name).write_text(f"# {formula} {name}\n")
+
+            # Some of the dotfiles already exist, so they need a backup.
+            if pattern == ".rc-*" and number % 2 == 0:
+                (home_path / name).write_text(f"# original {name}\n")
+
+    return home_path, bin_path
+
+
+def run_bench_command(root_path, env, arguments):
+    started = time.perf_counter()
+    completed_process = subprocess.run(
+        [sys.executable, PUBLICAN_FILENAME, *arguments],
+        cwd=root_path,
+        env=env,
+        input="Y\n" * 16,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        text=True,
+    )
+    return time.perf_counter() - started, completed_process.returncode
+
+
+def bench_commands(root_path, env, repeat):
+    """Time the publican subcommands end-to-end, in the order a user runs them."""
+
+    results = {name: {"runs": [], "returncodes": []} for name in BENCH_COMMANDS}
+    for _ in range(repeat):
+        for name, arguments in BENCH_COMMANDS.items():
+            elapsed, returncode = run_bench_command(root_path, env, arguments)
+            results[name]["runs"].append(elapsed)
+            results[name]["returncodes"].append(returncode)
+
+    return results
+
+
+def load_publican(root_path):
+    spec = importlib.util.spec_from_file_location(
+        "publican_bench", root_path / DOTPUB_FILENAME
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def bench_phases(root_path, env, repeat):
+    """Time the hot functions of publican one by one, inside this process."""
+
+    phases = {
+        "get_formula_info": [],
+        "yield_dotfiles": [],
+        "plan_mount_dotfile": [],
+        "probe_dotfile": [],
+    }
+
+    environ = os.environ.copy()
+    os.environ.update(env)
+    logging.disable(logging.CRITICAL)
+    try:
+        for _ in range(repeat):
+            publican = load_publican(root_path)
+            with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                formulae = publican.get_supported_formulae()
+
+                started = time.perf_counter()
+                infos = {
+                    formula: publican.get_formula_info(formula) for formula in formulae
+                }
+                phases["get_formula_info"].append(time.perf_counter() - started)
+
+                started = time.perf_counter()
+                configs = [
+                    config
+                    for formula, formula_info in infos.items()
+                    for config in publican.yield_dotfiles(formula, formula_info)
+                ]
+                phases["yield_dotfiles"].append(time.perf_counter() - started)
+
+                started = time.perf_counter()
+                for config in configs:
+                    publican.plan_mount_dotfile(**config)
+                phases["plan_mount_dotfile"].append(time.perf_counter() - started)
+
+                started = time.perf_counter()
+                for config in configs:
+                    publican.probe_dotfile(**config)
+                phases["probe_dotfile"].append(time.perf_counter() - started)
+    finally:
+        logging.disable(logging.NOTSET)
+        os.environ.clear()
+        os.environ.update(environ)
+
+    return {name: {"runs": runs} for name, runs in phases.items()}
+
+
+def summarize(results):
+    for result in results.values():
+        result["min"] = min(result["runs"])
+        result["median"] = statistics.median(result["runs"])
+        if "returncodes" in result:
+            result["failed"] = sum(1 for code in result["returncodes"] if code != 0)
+    return results
+
+
+def bench(args):
+    """Benchmark the publican subcommands against a synthetic counter."""
+
+    with tempfile.TemporaryDirectory(prefix="dotpub-bench-") as tmp_dir:
+        root_path = pathlib.Path(tmp_dir)
+        home_path, bin_path = make_bench_root(root_path, args.formulae, args.dotfiles)
+
+        env = os.environ.copy()
+        env["HOME"] = str(home_path)
+        env["BENCH_HOME"] = str(home_path)
+        env["PATH"] = os.pathsep.join([str(bin_path), env.get("PATH", "")])
+
+        report = {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "formulae": args.formulae,
+            "dotfiles": args.dotfiles,
+            "repeat": args.repeat,
+            "phases": summarize(bench_phases(root_path, env, args.repeat)),
+            "commands": summarize(bench_commands(root_path, env, args.repeat)),
+        }
+
+        if args.keep:
+            shutil.copytree(root_path, args.keep, symlinks=True)
+
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump(report, fp, indent=2)
+            fp.write("\n")
+
+    for group in ["phases", "commands"]:
+        print(f"{group}:")
+        for name, result in report[group].items():
+            line = (
+                f"  {name}:".ljust(24)
+                + f"min {result['min'] * 1000:10.2f} ms".ljust(20)
+                + f"median {result['median'] * 1000:10.2f} ms"
+            )
+            if result.get("failed"):
+                line += f"  failed {result['failed']}/{len(result['runs'])}"
+            print(line)
+
+    # A failed command is timed too, but its timing means nothing.
+    failed = {
+        name: [code for code in result["returncodes"] if code != 0]
+        for name, result in report["commands"].items()
+        if result["failed"]
+    }
+    for name, codes in failed.items():
+        arguments = " ".join(BENCH_COMMANDS[name])
+        print(f"`{arguments}` exited with {codes}.", file=sys.stderr)
+    if failed:
+        sys.exit(1)
+
+    return report
+
+
+# ==================================================
+# Main
+# ==================================================
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Test and debug the DotPub.")
+    subparsers = parser.add_subparsers(title="subcommands", metavar="ACTION")
+
+    bench_parser = subparsers.add_parser(
+        "bench",
+        description="Benchmark the publican subcommands against a synthetic counter.",
+        help="benchmark the publican subcommands against a synthetic counter",
+    )
+    bench_parser.add_argument(
+        "--formulae",
+        type=int,
+        default=200,
+        metavar="N",
+        help="generate N synthetic formulae",
+    )
+    bench_parser.add_argument(
+        "--dotfiles",
+        type=int,
+        default=12,
+        metavar="N",
+        help="generate N dotfiles for each formula",
+    )
+    bench_parser.add_argument(
+        "--repeat",
+        type=int,
+        default=3,
+        metavar="N",
+        help="repeat every measurement N times",
+    )
+    bench_parser.add_argument(
+        "-o",
+        "--output",
+        type=str,
+        metavar="PATH",
+        help="write the results as JSON to PATH",
+    )
+    bench_parser.add_argument(
+        "--keep",
+        type=str,
+        metavar="PATH",
+        help="keep a copy of the synthetic DotPub at PATH",
+    )
+    bench_parser.set_defaults(handler=bench)
+
+    test_parser = subparsers.add_parser(
+        "test",
+        description="Run the behaviour tests, each against a DotPub of its own.",
+        help="run the behaviour tests, each against a DotPub of its own",
+    )
+    test_parser.add_argument(
+        "names",
+        type=str,
+        nargs="*",
+        metavar="NAMES",
+        help="run only the tests of those names",
+    )
+    test_parser.set_defaults(handler=test)
+
+    args = parser.parse_args()
+    if hasattr(args, "handler"):
+        args.handler(args)
+    else:
+        debug()
+
+
 if __name__ == "__main__":
     main()